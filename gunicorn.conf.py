@@ -0,0 +1,119 @@
+# ================= GUNICORN (PRODUÇÃO) =================
+# gunicorn -c gunicorn.conf.py recuperadordecontas:app
+#
+# Tudo pode ser mudado por variáveis de ambiente sem tocar no código:
+#   WEB_CONCURRENCY        nº de workers (por omissão ver calcular_workers)
+#   GUNICORN_MAX_WORKERS   teto do cálculo automático (omissão 8)
+#   GUNICORN_THREADS       threads por worker (gthread)
+#   GUNICORN_TIMEOUT       segundos até um worker parado ser reiniciado
+#
+# Com Postgres cada worker abre até pool_size + max_overflow ligações
+# (ver BASE DE DADOS em recuperadordecontas.py): workers x threads conta.
+#
+# Só usamos gthread. gevent obrigaria a fazer monkey-patch antes do
+# preload (senão as threads, locks e sockets já criados pela app ficam
+# bloqueantes) e o pool de hashing/imagens não foi pensado para isso.
+#
+# Estado por processo (auditado para vários workers):
+#   - login Google: handoff guardado em oauth_handoffs (partilhado)
+#   - sessoes_cache / perfis_cache: cada worker só invalida a sua cópia;
+#     os outros veem a mudança no fim do TTL (SESSION_CACHE_TTL, 2 s;
+#     PROFILE_CACHE_TTL)
+#   - índice de pesquisa de users: reconstruído a cada USER_SEARCH_TTL
+#   - canal_tickets (SSE): só avisa quem está no mesmo worker; os outros
+#     apanham a mensagem na consulta à BD a cada TICKET_STREAM_POLL (2 s).
+#     Cada worker aceita no máximo TICKET_STREAM_MAX streams
+#   - retenção e corte de timelines: só um worker de cada vez (lease em
+#     tarefas_lease)
+#   - pools de hashing/imagens e tarefas periódicas: recriados por pid
+#     depois do fork
+#   - ACTIVITY_LOG_MODE=buffer: cada worker tem o seu lote
+import math
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "10000")
+
+def ler_quota_cgroup():
+    """Núcleos permitidos pela quota de CPU do container, ou None."""
+
+    # cgroup v2: "<quota> <período>" ou "max <período>"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, periodo = f.read().split()
+
+        if quota != "max":
+            return int(quota) / int(periodo)
+
+        return None
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1: quota -1 quer dizer sem limite
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            periodo = int(f.read())
+
+        if quota > 0 and periodo > 0:
+            return quota / periodo
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+def nucleos_disponiveis():
+    # cpu_count() dá os núcleos da máquina, não os do container
+    try:
+        nucleos = len(os.sched_getaffinity(0))
+    except AttributeError:
+        nucleos = os.cpu_count() or 1
+
+    quota = ler_quota_cgroup()
+
+    if quota:
+        nucleos = min(nucleos, max(1, math.ceil(quota)))
+
+    return nucleos
+
+def calcular_workers():
+
+    # SQLite só tem um escritor de cada vez: mais processos só trazem
+    # mais "database is locked" e mais caches por invalidar
+    url = os.environ.get("DATABASE_URL", "sqlite")
+
+    if url.startswith("sqlite"):
+        return 2
+
+    maximo = int(os.environ.get("GUNICORN_MAX_WORKERS", 8))
+
+    return max(1, min(nucleos_disponiveis() * 2 + 1, maximo))
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 0)) or calcular_workers()
+
+# gthread: uploads lentos e streams de tickets (SSE) ocupam uma thread,
+# não o worker inteiro
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# create_all, migrações e manifesto de media correm uma vez, no master
+preload_app = True
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# recicla workers de vez em quando (fugas de memória em libs externas)
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+
+accesslog = "-"
+errorlog = "-"
+
+def post_fork(server, worker):
+    # as ligações abertas pelo master (preload) não podem ser partilhadas
+    from recuperadordecontas import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
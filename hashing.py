@@ -0,0 +1,141 @@
+# ================= PASSWORDS =================
+# Algoritmos de hashing das passwords. Fica num módulo à parte, sem
+# efeitos ao importar (nada de app, db ou migrações), porque os processos
+# do pool de hashing (forkserver) importam-no para correr _verificar_hash.
+#
+# Cada hash guardado começa pelo nome do algoritmo ("scrypt$...").
+# As passwords antigas são sha256 em hex, sem prefixo, e são convertidas
+# para o algoritmo atual no próximo login (ver confirmar_password).
+import base64
+import hashlib
+import hmac
+import os
+
+class HasherSha256Legado:
+
+    nome = "sha256"
+
+    def gerar(self, password):
+        return hashlib.sha256(password.encode()).hexdigest()
+
+    def verificar(self, password, guardado):
+        return hmac.compare_digest(self.gerar(password), guardado)
+
+    def parametros_atuais(self, guardado):
+        return False
+
+class HasherScrypt:
+
+    nome = "scrypt"
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def _derivar(self, password, salt, n, r, p):
+        return hashlib.scrypt(
+            password.encode(),
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=256 * n * r,
+            dklen=32
+        )
+
+    def gerar(self, password):
+        salt = os.urandom(16)
+        chave = self._derivar(password, salt, self.n, self.r, self.p)
+
+        return "$".join([
+            self.nome,
+            str(self.n),
+            str(self.r),
+            str(self.p),
+            base64.b64encode(salt).decode().rstrip("="),
+            base64.b64encode(chave).decode().rstrip("=")
+        ])
+
+    def verificar(self, password, guardado):
+        _, n, r, p, salt, chave = guardado.split("$")
+
+        calculada = self._derivar(
+            password,
+            base64.b64decode(salt + "=="),
+            int(n),
+            int(r),
+            int(p)
+        )
+
+        return hmac.compare_digest(
+            calculada,
+            base64.b64decode(chave + "==")
+        )
+
+    def parametros_atuais(self, guardado):
+        return guardado.split("$")[1:4] == [str(self.n), str(self.r), str(self.p)]
+
+class HasherPbkdf2:
+
+    nome = "pbkdf2_sha256"
+
+    def __init__(self, iteracoes=600_000):
+        self.iteracoes = iteracoes
+
+    def gerar(self, password):
+        salt = os.urandom(16)
+        chave = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, self.iteracoes)
+
+        return "$".join([
+            self.nome,
+            str(self.iteracoes),
+            base64.b64encode(salt).decode().rstrip("="),
+            base64.b64encode(chave).decode().rstrip("=")
+        ])
+
+    def verificar(self, password, guardado):
+        _, iteracoes, salt, chave = guardado.split("$")
+
+        calculada = hashlib.pbkdf2_hmac(
+            "sha256",
+            password.encode(),
+            base64.b64decode(salt + "=="),
+            int(iteracoes)
+        )
+
+        return hmac.compare_digest(
+            calculada,
+            base64.b64decode(chave + "==")
+        )
+
+    def parametros_atuais(self, guardado):
+        return guardado.split("$")[1] == str(self.iteracoes)
+
+HASHERS = {
+    h.nome: h
+    for h in [HasherScrypt(), HasherPbkdf2(), HasherSha256Legado()]
+}
+
+# PASSWORD_HASHER escolhe o algoritmo das passwords novas
+HASHER_ATUAL = HASHERS[os.environ.get("PASSWORD_HASHER", "scrypt")]
+
+def hasher_de(guardado):
+    # None se o prefixo não for de nenhum algoritmo conhecido
+    nome = guardado.split("$", 1)[0] if "$" in guardado else "sha256"
+    return HASHERS.get(nome)
+
+def _gerar_hash(password):
+    return HASHER_ATUAL.gerar(password)
+
+def _verificar_hash(password, guardado):
+    hasher = hasher_de(guardado)
+
+    if hasher is None:
+        return False
+
+    # hash truncado ou corrompido na BD: conta como password errada
+    try:
+        return hasher.verificar(password, guardado)
+    except ValueError:
+        return False
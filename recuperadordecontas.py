@@ -1,8 +1,11 @@
 from flask import Flask, render_template, request, jsonify, send_from_directory, session, url_for,redirect
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
 import os
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime, timedelta
 from flask import send_from_directory
 from flask import request
@@ -16,8 +19,25 @@ import hmac
 import base64
 import json
 import uuid
-from flask import session
+from flask import session, g, Response, stream_with_context, send_file
+from markupsafe import escape
 import secrets
+import threading
+import multiprocessing
+import atexit
+import queue
+import bisect
+import unicodedata
+import tempfile
+import mimetypes
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+
+# Pillow é opcional: sem ele as imagens são servidas só no original
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 # ================= APP =================
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -30,35 +50,87 @@ app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 # garantir que a pasta existe (Render)
 os.makedirs(os.path.join(UPLOAD_FOLDER, "fotos"), exist_ok=True)
 
-google_login_state = {
-    "logged": False,
-    "exists": False,
-    "id": None,
-    "email": None,
-    "username": None,
-    "picture": None,
-    "google_name": None,
-    "session_token": None
-}
-
-# ================= SERVIR AVATARES =================
-@app.route('/avatar/<filename>')
-def servir_avatar(filename):
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    path = os.path.join(base_dir, 'static', 'avatars')
-
-    print("A SERVIR AVATAR:", filename)
-    print("PASTA:", path)
-
-    return send_from_directory(path, filename)
 # ================= CONFIG =================
 app.config["SECRET_KEY"] = "recuperar-secret"
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(BASE_DIR, "users.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# tamanho máximo de um pedido (soma de todos os ficheiros), em MB
+app.config["MAX_CONTENT_LENGTH"] = int(
+    os.environ.get("UPLOAD_MAX_REQUEST_MB", 60)
+) * 1024 * 1024
+
+# ================= BASE DE DADOS =================
+# DATABASE_URL escolhe a base de dados (por omissão o SQLite local).
+# Mudar para Postgres é só definir DATABASE_URL=postgres://...
+DATABASE_URL = os.environ.get(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(BASE_DIR, "users.db")
+)
+
+# o Render/Heroku dão "postgres://", que o SQLAlchemy 2 já não aceita
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
+
+# SQLite: WAL deixa ler enquanto alguém escreve, e busy_timeout faz as
+# escritas concorrentes (likes, heartbeats, atividade) esperarem pela
+# vez em vez de falharem com "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+}
+
+if DATABASE_URL.startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "connect_args": {
+            # o timeout do sqlite3 é em segundos
+            "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000
+        }
+    }
+else:
+    # Cada worker do gunicorn tem o seu pool. Por omissão chega uma
+    # ligação por thread de pedidos (GUNICORN_THREADS), uma por thread de
+    # imagens (IMAGE_WORKERS) e uma para as tarefas periódicas; o overflow
+    # cobre picos curtos (ex.: o handoff do OAuth usa uma ligação à parte).
+    #
+    # Ligações por deploy = workers x (pool_size + max_overflow).
+    # Com as omissões: (8 + 2 + 1) + 2 = 13 por worker, ou seja 26 com 2
+    # workers e 104 com 8 (o teto de GUNICORN_MAX_WORKERS), acima do
+    # max_connections=100 do Postgres: baixar workers/threads ou usar um
+    # pgbouncer à frente.
+    DB_POOL_SIZE = int(os.environ.get(
+        "DB_POOL_SIZE",
+        int(os.environ.get("GUNICORN_THREADS", 8))
+        + int(os.environ.get("IMAGE_WORKERS", 2))
+        + 1
+    ))
+
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 2)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True
+    }
+
 # ================= DB =================
 db = SQLAlchemy(app)
 
+def configurar_sqlite(ligacao, _registo):
+    cursor = ligacao.cursor()
+
+    for pragma, valor in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={valor}")
+
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        db.event.listen(db.engine, "connect", configurar_sqlite)
+
 oauth = OAuth(app)
 
 google = oauth.register(
@@ -390,7 +462,75 @@ class User(db.Model):
         db.Boolean,
         default=False
     )
-    
+
+
+    # ================= POR LER =================
+    # Mantidos nas rotas (ver recalcular_por_ler)
+
+    notificacoes_por_ler = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
+    mensagens_por_ler = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
+    pedidos_seguir_pendentes = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
+
+    # ================= SEGUIDORES =================
+    # Mantidos nas rotas (ver recalcular_seguidores)
+
+    seguidores_total = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
+    seguindo_total = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
+# Login/recuperação procuram sempre em minúsculas
+db.Index("ix_users_lower_username", func.lower(User.username))
+db.Index("ix_users_lower_email", func.lower(User.email))
+db.Index("ix_users_lower_email_recuperacao", func.lower(User.email_recuperacao))
+
+CAMPOS_IDENTIDADE = ("username", "email", "email_recuperacao")
+
+def normalizar_identidade(valor):
+    """
+    Forma guardada de username/emails: NFC e minúsculas (Unicode).
+    O lower() do SQLite só trata ASCII, por isso os valores já têm de
+    estar em minúsculas na base de dados para as pesquisas baterem certo.
+    """
+
+    if valor is None:
+        return None
+
+    return unicodedata.normalize("NFC", valor.strip()).lower()
+
+@db.event.listens_for(User.username, "set", retval=True)
+@db.event.listens_for(User.email, "set", retval=True)
+@db.event.listens_for(User.email_recuperacao, "set", retval=True)
+def normalizar_identidade_ao_gravar(target, value, oldvalue, initiator):
+    return normalizar_identidade(value)
+
 from datetime import datetime
 
 class PostImage(db.Model):
@@ -413,6 +553,10 @@ class PostImage(db.Model):
         nullable=False
     )
 
+    # variantes em WebP (preenchidas em background, ver gerar_variantes)
+    miniatura = db.Column(db.String(500))
+    caminho_feed = db.Column(db.String(500))
+
 class Report(db.Model):
 
     __tablename__ = "reports"
@@ -538,10 +682,18 @@ class FollowRequest(db.Model):
         default="pending"
     )
 
+    # nomes usados pelas rotas /follow/*
+    from_user = db.synonym("sender_id")
+    to_user = db.synonym("receiver_id")
+
 class UserSession(db.Model):
 
     __tablename__ = "user_sessions"
 
+    __table_args__ = (
+        db.Index("ix_user_sessions_user_active", "user_id", "active"),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -596,6 +748,10 @@ class AccountActivity(db.Model):
 
     __tablename__ = "account_activity"
 
+    __table_args__ = (
+        db.Index("ix_account_activity_user_created", "user_id", "created_at"),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -654,6 +810,10 @@ class AdminActivity(db.Model):
 
     __tablename__ = "admin_activity"
 
+    __table_args__ = (
+        db.Index("ix_admin_activity_user_action", "user_id", "action"),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -740,6 +900,11 @@ class Post(db.Model):
 
     __tablename__ = "posts"
 
+    __table_args__ = (
+        db.Index("ix_posts_data_id", "data", "id"),
+        db.Index("ix_posts_autor_data", "autor_id", "data"),
+    )
+
 
     id = db.Column(
         db.String,
@@ -784,8 +949,27 @@ class Post(db.Model):
         default=datetime.utcnow
     )
 
+    # Contadores mantidos nas rotas (ver recalcular_contadores)
+    total_likes = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
+    total_comentarios = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (
+        db.Index("ix_comments_post_data", "post_id", "data"),
+        db.Index("ix_comments_parent_data", "parent_id", "data"),
+    )
 
     id = db.Column(db.String, primary_key=True)
 
@@ -805,6 +989,8 @@ class Comment(db.Model):
 
     # 🔥 FALTAVA ISTO
     imagem = db.Column(db.String)
+    imagem_miniatura = db.Column(db.String(500))
+    imagem_feed = db.Column(db.String(500))
 
     parent_id = db.Column(
         db.String,
@@ -816,6 +1002,13 @@ class Comment(db.Model):
         default=datetime.utcnow
     )
 
+    total_likes = db.Column(
+        db.Integer,
+        default=0,
+        server_default="0",
+        nullable=False
+    )
+
 class Ticket(db.Model):
     __tablename__ = "tickets"
 
@@ -848,6 +1041,9 @@ class TicketMessage(db.Model):
 
 class Like(db.Model):
     __tablename__ = "likes"
+    __table_args__ = (
+        db.Index("ix_likes_post_user", "post_id", "user_id"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     post_id = db.Column(db.String, db.ForeignKey("posts.id", ondelete="CASCADE"))
@@ -856,6 +1052,9 @@ class Like(db.Model):
 
 class CommentLike(db.Model):
     __tablename__ = "comment_likes"
+    __table_args__ = (
+        db.Index("ix_comment_likes_comment_user", "comment_id", "user_id"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     comment_id = db.Column(db.String, db.ForeignKey("comments.id", ondelete="CASCADE"))
@@ -863,6 +1062,10 @@ class CommentLike(db.Model):
 
 class Follow(db.Model):
     __tablename__ = "follows"
+    __table_args__ = (
+        db.Index("ix_follows_follower_followed", "follower_id", "followed_id"),
+        db.Index("ix_follows_followed", "followed_id"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     follower_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -870,6 +1073,10 @@ class Follow(db.Model):
 
 class Block(db.Model):
     __tablename__ = "blocks"
+    __table_args__ = (
+        db.Index("ix_blocks_blocker_blocked", "blocker_id", "blocked_id"),
+        db.Index("ix_blocks_blocked", "blocked_id"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     blocker_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -877,6 +1084,10 @@ class Block(db.Model):
 
 class Notification(db.Model):
     __tablename__ = "notifications"
+    __table_args__ = (
+        db.Index("ix_notifications_user_lida_data", "user_id", "lida", "data"),
+        db.Index("ix_notifications_user_data", "user_id", "data"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -889,6 +1100,10 @@ class Notification(db.Model):
 
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        db.Index("ix_messages_from_to_data", "from_user_id", "to_user_id", "data"),
+        db.Index("ix_messages_to_lida", "to_user_id", "lida"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     from_user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -897,13 +1112,91 @@ class Message(db.Model):
     lida = db.Column(db.Boolean, default=False)
     data = db.Column(db.DateTime, default=datetime.utcnow)
 
+class Conversation(db.Model):
+    """
+    Uma linha por par de utilizadores (user_a_id < user_b_id) com a
+    última mensagem e as mensagens por ler de cada lado.
+    Mantida por enviar_mensagem/marcar_lidas (ver registar_mensagem_conversa).
+    """
+
+    __tablename__ = "conversations"
+    __table_args__ = (
+        db.UniqueConstraint("user_a_id", "user_b_id", name="uq_conversations_par"),
+        db.Index("ix_conversations_a_data", "user_a_id", "data"),
+        db.Index("ix_conversations_b_data", "user_b_id", "data"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_a_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_b_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+
+    ultima_mensagem_id = db.Column(db.String)
+    ultima_mensagem = db.Column(db.Text)
+    ultimo_remetente_id = db.Column(db.Integer)
+
+    # data da última mensagem (ordena a inbox)
+    data = db.Column(db.DateTime, default=datetime.utcnow)
+
+    por_ler_a = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    por_ler_b = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+
+class TimelineEntry(db.Model):
+    """Posts empurrados para a timeline "a seguir" de cada utilizador."""
+
+    __tablename__ = "timeline_entries"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "post_id", name="uq_timeline_user_post"),
+        db.Index("ix_timeline_user_data", "user_id", "data", "post_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    post_id = db.Column(db.String, nullable=False)
+    autor_id = db.Column(db.Integer, nullable=False)
+
+    # data do post (ordena a timeline)
+    data = db.Column(db.DateTime, nullable=False)
+
+class TimelineEstado(db.Model):
+    """Quando a timeline foi construída e lida pela última vez."""
+
+    __tablename__ = "timelines"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    construida_em = db.Column(db.DateTime, default=datetime.utcnow)
+    lida_em = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class OAuthHandoff(db.Model):
+    """Resultado de um login Google à espera que a app o vá buscar."""
+
+    __tablename__ = "oauth_handoffs"
+
+    # sha256 do verifier da app (challenge)
+    nonce = db.Column(db.String(128), primary_key=True)
+    dados = db.Column(db.Text, nullable=False)
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+
+class TarefaLease(db.Model):
+    """Qual processo ficou com a vez de correr uma tarefa periódica."""
+
+    __tablename__ = "tarefas_lease"
+
+    nome = db.Column(db.String(80), primary_key=True)
+    dono = db.Column(db.String(80))
+    ate = db.Column(db.DateTime, nullable=False)
+
 class Share(db.Model):
     __tablename__ = "shares"
+    __table_args__ = (
+        db.Index("ix_shares_to_data", "to_user_id", "data"),
+    )
 
     id = db.Column(db.String, primary_key=True)
     post_id = db.Column(db.String, db.ForeignKey("posts.id"))
     from_user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     to_user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    data = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class ReportPost(db.Model):
@@ -929,148 +1222,1606 @@ class GoogleLogin(db.Model):
     username = db.Column(db.String(80))
     logged = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime)
-# ================= CRIAR TABELAS =================
-with app.app_context():
-    db.create_all()
-# ================= CONFIG CÓDIGOS =================
-SIGN_SECRET = b"recuperacao-super-secreta"
-CODE_EXPIRATION = 300  # 5 minutos
+# ================= CONTADORES =================
+def ajustar_contador(coluna, item_id, delta):
+    """Soma delta ao contador na própria BD (sem ler o valor antes)."""
 
-# ================= UTILS =================
-def hash_password(p):
-    return hashlib.sha256(p.encode()).hexdigest()
+    modelo = coluna.class_
 
-def generate_code(tipo):
-    # 16 caracteres hex (compatível com o app)
-    return os.urandom(16).hex()
+    modelo.query.filter(
+        modelo.id == item_id
+    ).update(
+        {coluna: coluna + delta},
+        synchronize_session=False
+    )
 
-def validate_code(token, tipo_esperado):
-    if (
-        not token
-        or len(token) != 32
-        or not all(c in "0123456789abcdef" for c in token.lower())
-    ):
-        return False, "Código inválido"
+def recalcular_contadores(post_ids=None, comment_ids=None):
+    """
+    Recalcula os contadores a partir das tabelas de likes/comentários.
+    Sem argumentos recalcula tudo; post_ids/comment_ids podem ser
+    listas ou subqueries.
+    """
 
-    return True, "OK"
+    posts = Post.query
 
-def hash_resposta(resposta: str) -> str:
-    return hashlib.sha256(resposta.strip().lower().encode()).hexdigest()
+    if post_ids is not None:
+        posts = posts.filter(Post.id.in_(post_ids))
 
-def existe_bloqueio(a, b):
-    return db.session.query(Block.id).filter(
+    posts.update(
+        {
+            Post.total_likes: (
+                db.session.query(func.count(Like.id))
+                .filter(Like.post_id == Post.id)
+                .scalar_subquery()
+            ),
+            Post.total_comentarios: (
+                db.session.query(func.count(Comment.id))
+                .filter(Comment.post_id == Post.id)
+                .scalar_subquery()
+            )
+        },
+        synchronize_session=False
+    )
+
+    comentarios = Comment.query
+
+    if comment_ids is not None:
+        comentarios = comentarios.filter(Comment.id.in_(comment_ids))
+
+    comentarios.update(
+        {
+            Comment.total_likes: (
+                db.session.query(func.count(CommentLike.id))
+                .filter(CommentLike.comment_id == Comment.id)
+                .scalar_subquery()
+            )
+        },
+        synchronize_session=False
+    )
+
+def contadores_afetados_por(user_id):
+    """Posts e comentários cujos contadores mudam ao limpar um user."""
+
+    posts = {
+        pid for (pid,) in db.session.query(Like.post_id).filter_by(user_id=user_id)
+    } | {
+        pid for (pid,) in db.session.query(Comment.post_id).filter_by(autor_id=user_id)
+    }
+
+    comentarios = {
+        cid for (cid,) in db.session.query(CommentLike.comment_id).filter_by(user_id=user_id)
+    }
+
+    return list(posts), list(comentarios)
+
+@app.cli.command("recontar-contadores")
+def recontar_contadores_cmd():
+    recalcular_contadores()
+    recalcular_por_ler()
+    recalcular_seguidores()
+    db.session.commit()
+    print("Contadores recalculados")
+
+# ================= POR LER =================
+# Notificações e mensagens de utilizadores bloqueados (nos dois sentidos)
+# não contam, tal como não aparecem nas listas.
+def sem_bloqueio_entre(a, b):
+    """Condição SQL: não há bloqueio entre as colunas a e b (em nenhum sentido)."""
+    return ~db.session.query(Block.id).filter(
         db.or_(
             db.and_(Block.blocker_id == a, Block.blocked_id == b),
             db.and_(Block.blocker_id == b, Block.blocked_id == a)
         )
-    ).first() is not None
+    ).exists()
 
-def adicionar_atividade(
-        user_id,
-        tipo,
-        descricao,
-        antigo="",
-        novo="",
-        origem="user",
-        admin_id=None
-):
+def _sem_bloqueio(origem):
+    return sem_bloqueio_entre(User.id, origem)
 
-    db.session.add(
+def recalcular_por_ler(user_ids=None):
+    """Recalcula os contadores por ler; sem argumentos recalcula todos."""
 
-        AccountActivity(
+    users = User.query
 
-            user_id=user_id,
+    if user_ids is not None:
+        users = users.filter(User.id.in_(user_ids))
 
-            admin_id=admin_id,
+    users.update(
+        {
+            User.notificacoes_por_ler: (
+                db.session.query(func.count(Notification.id))
+                .filter(
+                    Notification.user_id == User.id,
+                    Notification.lida == False,
+                    _sem_bloqueio(Notification.origem_id)
+                )
+                .scalar_subquery()
+            ),
+            User.mensagens_por_ler: (
+                db.session.query(func.count(Message.id))
+                .filter(
+                    Message.to_user_id == User.id,
+                    Message.lida == False,
+                    _sem_bloqueio(Message.from_user_id)
+                )
+                .scalar_subquery()
+            ),
+            User.pedidos_seguir_pendentes: (
+                db.session.query(func.count(FollowRequest.id))
+                .filter(
+                    FollowRequest.receiver_id == User.id,
+                    FollowRequest.status == "pending"
+                )
+                .scalar_subquery()
+            )
+        },
+        synchronize_session=False
+    )
 
-            activity_type=tipo,
+def criar_notificacao(user_id, tipo, origem_id=None, **campos):
 
-            description=descricao,
+    db.session.add(Notification(
+        id=str(uuid.uuid4()),
+        user_id=user_id,
+        tipo=tipo,
+        origem_id=origem_id,
+        **campos
+    ))
 
-            old_value=antigo,
+    if not origem_id or int(origem_id) not in bloqueios_de(user_id):
+        ajustar_contador(User.notificacoes_por_ler, user_id, 1)
 
-            new_value=novo,
+def descontar_pedido_seguir(req):
+    if req.status == "pending":
+        ajustar_contador(User.pedidos_seguir_pendentes, req.receiver_id, -1)
 
-            origem=origem
+def apagar_notificacoes(*condicoes):
+    """Apaga notificações e acerta o contador de quem as tinha por ler."""
 
-        )
+    afetados = [
+        uid for (uid,) in db.session.query(Notification.user_id).filter(
+            Notification.lida == False,
+            *condicoes
+        ).distinct()
+    ]
 
-    )
+    Notification.query.filter(*condicoes).delete(synchronize_session=False)
 
-    db.session.commit()
-    
-def is_admin(user_id):
+    if afetados:
+        recalcular_por_ler(afetados)
 
-    if not user_id:
-        return False
+def apagar_mensagens(*condicoes):
+    """Apaga mensagens e acerta o contador de quem as tinha por ler."""
 
-    user = User.query.get(user_id)
+    afetados = [
+        uid for (uid,) in db.session.query(Message.to_user_id).filter(
+            Message.lida == False,
+            *condicoes
+        ).distinct()
+    ]
 
-    if not user:
-        return False
+    pares = {
+        par_conversa(a, b)
+        for a, b in db.session.query(
+            Message.from_user_id,
+            Message.to_user_id
+        ).filter(*condicoes).distinct()
+    }
 
-    return user.id == 1 or user.role == "admin"
+    Message.query.filter(*condicoes).delete(synchronize_session=False)
 
-def admin_required(user_id):
-    user = User.query.get(user_id)
-    if not user or user.role != "admin":
-        return False, jsonify(error="Sem permissão"), 403
-    return True, user
+    if afetados:
+        recalcular_por_ler(afetados)
 
-def admin_ticket_required(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        user_id = session.get("user_id")
+    if pares:
+        recalcular_conversas(pares)
 
-        if not user_id:
-            return jsonify(error="Sessão inválida"), 401
+# ================= SEGUIDORES =================
+def recalcular_seguidores(user_ids=None):
+    """
+    Recalcula seguidores/seguindo; sem argumentos recalcula todos.
+    O recálculo total só corre na migração (ao importar, antes de existir
+    a cache de perfis) e no "flask recontar-contadores" (outro processo),
+    por isso só os perfis pedidos são invalidados.
+    """
 
-        if not is_admin(user_id):
-            return jsonify(error="Sem permissão"), 403
+    users = User.query
 
-        return func(*args, **kwargs)
+    if user_ids is not None:
+        users = users.filter(User.id.in_(user_ids))
 
-    return wrapper
-# ================= ROTAS PÁGINAS =================
-@app.route("/")
-def home():
-    return render_template("index.html")
+    users.update(
+        {
+            User.seguidores_total: (
+                db.session.query(func.count(Follow.id))
+                .filter(Follow.followed_id == User.id)
+                .scalar_subquery()
+            ),
+            User.seguindo_total: (
+                db.session.query(func.count(Follow.id))
+                .filter(Follow.follower_id == User.id)
+                .scalar_subquery()
+            )
+        },
+        synchronize_session=False
+    )
 
-@app.route("/recover-password")
-def recover_password():
-    return render_template("recover_password.html")
+    for uid in user_ids or ():
+        invalidar_perfil(uid)
 
-@app.route("/recover-username")
-def recover_username():
-    return render_template("recover_username.html")
-    
-# ================= API GERAR CÓDIGOS =================
-@app.route("/api/generate-password-code", methods=["GET"])
-def generate_password_code():
-    token = generate_code("password")
-    return jsonify(status="ok", token=token, expires=CODE_EXPIRATION)
+def ajustar_seguidores(follower_id, followed_id, delta):
+    ajustar_contador(User.seguindo_total, follower_id, delta)
+    ajustar_contador(User.seguidores_total, followed_id, delta)
 
-@app.route("/api/generate-username-code", methods=["GET"])
-def generate_username_code():
-    token = generate_code("username")
-    return jsonify(status="ok", token=token, expires=CODE_EXPIRATION)
+    invalidar_perfil(follower_id)
+    invalidar_perfil(followed_id)
 
-# ================= API VALIDAR CÓDIGOS =================
-@app.route("/api/validate-password-code", methods=["POST"])
-def validate_password_code():
-    data = request.get_json(silent=True) or {}
-    code = (data.get("code") or "").strip()
+    # quem segue passa a ter outra lista de autores
+    invalidar_timelines([follower_id])
 
-    ok, msg = validate_code(code, "password")
-    if not ok:
-        return jsonify(status="error", msg=msg)
+def apagar_follows(*condicoes):
+    """Apaga follows e recalcula os contadores dos dois lados."""
 
-    return jsonify(status="ok")
+    afetados = set()
+    seguidores = set()
 
-@app.route("/api/validate-username-code", methods=["POST"])
-def validate_username_code():
-    data = request.get_json(silent=True) or {}
-    code = (data.get("code") or "").strip()
+    for a, b in db.session.query(
+        Follow.follower_id,
+        Follow.followed_id
+    ).filter(*condicoes):
+        afetados.update((a, b))
+        seguidores.add(a)
+
+    Follow.query.filter(*condicoes).delete(synchronize_session=False)
+
+    if afetados:
+        recalcular_seguidores(list(afetados))
+        invalidar_timelines(list(seguidores))
+
+# ================= CONVERSAS =================
+def par_conversa(a, b):
+    a, b = int(a), int(b)
+    return (a, b) if a < b else (b, a)
+
+def lado_conversa(user_id, outro_id):
+    """(user_a, user_b, coluna por ler de user_id)."""
+
+    a, b = par_conversa(user_id, outro_id)
+    por_ler = Conversation.por_ler_a if int(user_id) == a else Conversation.por_ler_b
+
+    return a, b, por_ler
+
+def registar_mensagem_conversa(msg):
+    """Atualiza (ou cria) a conversa do par com a mensagem acabada de gravar."""
+
+    a, b, por_ler = lado_conversa(msg.to_user_id, msg.from_user_id)
+
+    valores = {
+        Conversation.ultima_mensagem_id: msg.id,
+        Conversation.ultima_mensagem: msg.texto,
+        Conversation.ultimo_remetente_id: msg.from_user_id,
+        Conversation.data: msg.data,
+        por_ler: por_ler + 1
+    }
+
+    existe = Conversation.query.filter_by(
+        user_a_id=a,
+        user_b_id=b
+    ).update(valores, synchronize_session=False)
+
+    if existe:
+        return
+
+    try:
+        # primeira mensagem do par; outro pedido pode criá-la ao mesmo tempo
+        with db.session.begin_nested():
+            db.session.add(Conversation(
+                user_a_id=a,
+                user_b_id=b,
+                ultima_mensagem_id=msg.id,
+                ultima_mensagem=msg.texto,
+                ultimo_remetente_id=msg.from_user_id,
+                data=msg.data,
+                por_ler_a=1 if por_ler is Conversation.por_ler_a else 0,
+                por_ler_b=1 if por_ler is Conversation.por_ler_b else 0
+            ))
+    except IntegrityError:
+        Conversation.query.filter_by(
+            user_a_id=a,
+            user_b_id=b
+        ).update(valores, synchronize_session=False)
+
+def recalcular_conversas(pares=None):
+    """
+    Reconstrói as conversas a partir das mensagens. Sem argumentos
+    reconstrói todas; pares sem mensagens deixam de ter conversa.
+    """
+
+    if pares is None:
+        Conversation.query.delete(synchronize_session=False)
+
+        pares = {
+            par_conversa(a, b)
+            for a, b in db.session.query(
+                Message.from_user_id,
+                Message.to_user_id
+            ).distinct()
+        }
+
+    for a, b in pares:
+
+        do_par = db.or_(
+            db.and_(Message.from_user_id == a, Message.to_user_id == b),
+            db.and_(Message.from_user_id == b, Message.to_user_id == a)
+        )
+
+        ultima = Message.query.filter(do_par).order_by(
+            Message.data.desc(),
+            Message.id.desc()
+        ).first()
+
+        conversa = Conversation.query.filter_by(
+            user_a_id=a,
+            user_b_id=b
+        ).first()
+
+        if not ultima:
+            if conversa:
+                db.session.delete(conversa)
+            continue
+
+        por_ler = dict(
+            db.session.query(
+                Message.to_user_id,
+                func.count(Message.id)
+            ).filter(
+                do_par,
+                Message.lida == False
+            ).group_by(Message.to_user_id).all()
+        )
+
+        if not conversa:
+            conversa = Conversation(user_a_id=a, user_b_id=b)
+            db.session.add(conversa)
+
+        conversa.ultima_mensagem_id = ultima.id
+        conversa.ultima_mensagem = ultima.texto
+        conversa.ultimo_remetente_id = ultima.from_user_id
+        conversa.data = ultima.data
+        conversa.por_ler_a = por_ler.get(a, 0)
+        conversa.por_ler_b = por_ler.get(b, 0)
+
+# ================= MIGRAÇÕES =================
+# O create_all só cria tabelas novas. Tudo o que altera tabelas que já
+# existem em produção (colunas, índices) é uma migração numerada,
+# aplicada uma única vez e registada em schema_migrations.
+# As migrações têm de ser idempotentes: vários workers podem arrancar
+# ao mesmo tempo e aplicar a mesma versão.
+#
+# O ALTER TABLE fica gravado logo (adicionar_coluna tem a sua própria
+# transação), mas a versão só é registada no fim. Por isso o preenchimento
+# das colunas novas corre sempre, não só quando a coluna acabou de ser
+# criada: se a migração falhar a meio, corre outra vez por inteiro no
+# próximo arranque.
+class SchemaMigration(db.Model):
+    __tablename__ = "schema_migrations"
+
+    versao = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(120))
+    aplicada_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+MIGRACOES = []
+
+def migracao(versao, nome):
+    def registar(func):
+        MIGRACOES.append((versao, nome, func))
+        return func
+    return registar
+
+def adicionar_coluna(tabela, coluna, tipo_sql):
+    """ALTER TABLE ... ADD COLUMN se ainda não existir. Devolve True se criou."""
+
+    existentes = {
+        c["name"] for c in db.inspect(db.engine).get_columns(tabela)
+    }
+
+    if coluna in existentes:
+        return False
+
+    with db.engine.begin() as conn:
+        conn.execute(db.text(
+            f"ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo_sql}"
+        ))
+
+    return True
+
+def criar_indice(indice):
+    """
+    Cria um índice declarado num modelo, se ainda não existir.
+    Em Postgres usa CONCURRENTLY (fora de transação) para não bloquear
+    as escritas na tabela enquanto o índice é construído.
+    """
+
+    ddl = str(
+        CreateIndex(indice, if_not_exists=True)
+        .compile(dialect=db.engine.dialect)
+    )
+
+    if db.engine.dialect.name == "postgresql":
+        ddl = ddl.replace("INDEX", "INDEX CONCURRENTLY", 1)
+
+        with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as conn:
+            conn.exec_driver_sql(ddl)
+
+        return
+
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(ddl)
+
+def criar_indices(*modelos):
+    for modelo in modelos:
+        for indice in modelo.__table__.indexes:
+            criar_indice(indice)
+
+@migracao(1, "contadores de likes e comentários")
+def migracao_contadores():
+
+    for tabela, coluna in [
+        ("posts", "total_likes"),
+        ("posts", "total_comentarios"),
+        ("comments", "total_likes")
+    ]:
+        adicionar_coluna(tabela, coluna, "INTEGER NOT NULL DEFAULT 0")
+
+    recalcular_contadores()
+    db.session.commit()
+
+@migracao(2, "índices das tabelas mais usadas")
+def migracao_indices():
+    criar_indices(
+        Post,
+        Comment,
+        Like,
+        CommentLike,
+        Follow,
+        Block,
+        Notification,
+        Message,
+        UserSession,
+        AccountActivity,
+        AdminActivity
+    )
+
+@migracao(3, "índices lower() de username/email")
+def migracao_indices_identidade():
+    criar_indices(User)
+
+@migracao(4, "contadores de notificações/mensagens por ler")
+def migracao_por_ler():
+
+    for coluna in [
+        "notificacoes_por_ler",
+        "mensagens_por_ler",
+        "pedidos_seguir_pendentes"
+    ]:
+        adicionar_coluna("users", coluna, "INTEGER NOT NULL DEFAULT 0")
+
+    recalcular_por_ler()
+    db.session.commit()
+
+@migracao(5, "índice das respostas a comentários")
+def migracao_indice_respostas():
+    criar_indices(Comment)
+
+@migracao(6, "índice da lista de notificações")
+def migracao_indice_notificacoes():
+    criar_indices(Notification)
+
+@migracao(7, "conversas a partir das mensagens")
+def migracao_conversas():
+    if not db.session.query(Conversation.id).first():
+        recalcular_conversas()
+        db.session.commit()
+
+@migracao(8, "data das partilhas")
+def migracao_data_partilhas():
+
+    adicionar_coluna("shares", "data", "TIMESTAMP")
+
+    # a data real perdeu-se; a do post é a melhor aproximação
+    Share.query.filter(
+        Share.data.is_(None)
+    ).update(
+        {
+            Share.data: func.coalesce(
+                db.session.query(Post.data)
+                .filter(Post.id == Share.post_id)
+                .scalar_subquery(),
+                datetime.utcnow()
+            )
+        },
+        synchronize_session=False
+    )
+
+    db.session.commit()
+
+    criar_indices(Share)
+
+@migracao(9, "contadores de seguidores")
+def migracao_seguidores():
+
+    for coluna in ["seguidores_total", "seguindo_total"]:
+        adicionar_coluna("users", coluna, "INTEGER NOT NULL DEFAULT 0")
+
+    recalcular_seguidores()
+    db.session.commit()
+
+@migracao(10, "variantes de imagens")
+def migracao_variantes_imagens():
+
+    adicionar_coluna("post_images", "miniatura", "VARCHAR(500)")
+    adicionar_coluna("post_images", "caminho_feed", "VARCHAR(500)")
+    adicionar_coluna("comments", "imagem_miniatura", "VARCHAR(500)")
+    adicionar_coluna("comments", "imagem_feed", "VARCHAR(500)")
+
+    # as imagens antigas: "flask gerar-variantes"
+
+@migracao(11, "identidades em minúsculas")
+def migracao_identidades_minusculas():
+
+    for campo in CAMPOS_IDENTIDADE:
+
+        coluna = getattr(User, campo)
+
+        for user_id, valor in db.session.query(User.id, coluna).filter(
+            coluna.isnot(None)
+        ).all():
+
+            normalizado = normalizar_identidade(valor)
+
+            if normalizado == valor:
+                continue
+
+            try:
+                with db.session.begin_nested():
+                    User.query.filter_by(id=user_id).update(
+                        {coluna: normalizado},
+                        synchronize_session=False
+                    )
+            except IntegrityError:
+                # já existe outra conta com o mesmo valor em minúsculas
+                print("IDENTIDADE DUPLICADA:", campo, user_id, valor)
+
+    db.session.commit()
+
+@migracao(12, "recontagem de seguidores")
+def migracao_recontar_seguidores():
+    # a 9 podia ficar registada sem ter contado os seguidores
+    recalcular_seguidores()
+    db.session.commit()
+
+def aplicar_migracoes():
+
+    feitas = {
+        versao for (versao,) in db.session.query(SchemaMigration.versao)
+    }
+
+    for versao, nome, func in sorted(MIGRACOES, key=lambda m: m[0]):
+
+        if versao in feitas:
+            continue
+
+        print(f"MIGRAÇÃO {versao}: {nome}")
+
+        func()
+
+        db.session.add(SchemaMigration(versao=versao, nome=nome))
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # outro worker registou a mesma versão primeiro
+            db.session.rollback()
+
+@app.cli.command("migrar")
+def migrar_cmd():
+    db.create_all()
+    aplicar_migracoes()
+    print("Base de dados atualizada")
+
+# ================= PLANO DE EXECUÇÃO =================
+# Consultas quentes e o índice que cada uma deve usar.
+# "flask --app recuperadordecontas verificar-indices" corre o EXPLAIN
+# de cada uma e falha se o índice não aparecer no plano.
+# Em Postgres o planeador pode preferir um seq scan em tabelas pequenas,
+# por isso convém correr numa cópia com dados reais.
+CONSULTAS_QUENTES = [
+    (
+        "feed",
+        "ix_posts_data_id",
+        lambda: db.select(Post.id).order_by(Post.data.desc(), Post.id.desc()).limit(20)
+    ),
+    (
+        "posts do perfil",
+        "ix_posts_autor_data",
+        lambda: db.select(Post.id).where(Post.autor_id == 1).order_by(Post.data.desc())
+    ),
+    (
+        "like existente",
+        "ix_likes_post_user",
+        lambda: db.select(Like.id).where(Like.post_id == "x", Like.user_id == 1)
+    ),
+    (
+        "comentários de um post",
+        "ix_comments_post_data",
+        lambda: db.select(Comment.id).where(Comment.post_id == "x").order_by(Comment.data)
+    ),
+    (
+        "respostas de um comentário",
+        "ix_comments_parent_data",
+        lambda: db.select(Comment.id).where(Comment.parent_id == "x").order_by(Comment.data)
+    ),
+    (
+        "likes de comentário",
+        "ix_comment_likes_comment_user",
+        lambda: db.select(CommentLike.id).where(CommentLike.comment_id == "x", CommentLike.user_id == 1)
+    ),
+    (
+        "notificações não lidas",
+        "ix_notifications_user_lida_data",
+        lambda: db.select(func.count(Notification.id)).where(Notification.user_id == 1, Notification.lida == False)
+    ),
+    (
+        "diretório de users",
+        "ix_users_lower_username",
+        lambda: db.select(User.id).where(func.lower(User.username) >= "a", func.lower(User.username) < "b").order_by(func.lower(User.username), User.id).limit(20)
+    ),
+    (
+        "conversas de um user",
+        "ix_conversations_b_data",
+        lambda: db.select(Conversation.id).where(db.or_(Conversation.user_a_id == 1, Conversation.user_b_id == 1)).order_by(Conversation.data.desc())
+    ),
+    (
+        "lista de notificações",
+        "ix_notifications_user_data",
+        lambda: db.select(Notification.id).where(Notification.user_id == 1).order_by(Notification.data.desc(), Notification.id.desc()).limit(20)
+    ),
+    (
+        "conversa",
+        "ix_messages_from_to_data",
+        lambda: db.select(Message.id).where(Message.from_user_id == 1, Message.to_user_id == 2).order_by(Message.data)
+    ),
+    (
+        "mensagens não lidas",
+        "ix_messages_to_lida",
+        lambda: db.select(Message.from_user_id).where(Message.to_user_id == 1, Message.lida == False)
+    ),
+    (
+        "partilhas recebidas",
+        "ix_shares_to_data",
+        lambda: db.select(Share.id).where(Share.to_user_id == 1).order_by(Share.data.desc(), Share.id.desc()).limit(20)
+    ),
+    (
+        "bloqueio",
+        "ix_blocks_blocker_blocked",
+        lambda: db.select(Block.id).where(Block.blocker_id == 1, Block.blocked_id == 2)
+    ),
+    (
+        "bloqueado por",
+        "ix_blocks_blocked",
+        lambda: db.select(Block.blocker_id).where(Block.blocked_id == 1)
+    ),
+    (
+        "seguidores",
+        "ix_follows_followed",
+        lambda: db.select(func.count(Follow.id)).where(Follow.followed_id == 1)
+    ),
+    (
+        "segue",
+        "ix_follows_follower_followed",
+        lambda: db.select(Follow.id).where(Follow.follower_id == 1, Follow.followed_id == 2)
+    ),
+    (
+        "sessões ativas",
+        "ix_user_sessions_user_active",
+        lambda: db.select(UserSession.id).where(UserSession.user_id == 1, UserSession.active == True)
+    ),
+    (
+        "atividade da conta",
+        "ix_account_activity_user_created",
+        lambda: db.select(AccountActivity.id).where(AccountActivity.user_id == 1).order_by(AccountActivity.created_at.desc())
+    ),
+    (
+        "ações de admin",
+        "ix_admin_activity_user_action",
+        lambda: db.select(func.count(AdminActivity.id)).where(AdminActivity.user_id == 1, AdminActivity.action == "ban")
+    )
+]
+
+def plano_de_execucao(consulta):
+
+    sql = str(consulta.compile(
+        dialect=db.engine.dialect,
+        compile_kwargs={"literal_binds": True}
+    ))
+
+    prefixo = (
+        "EXPLAIN QUERY PLAN "
+        if db.engine.dialect.name == "sqlite"
+        else "EXPLAIN "
+    )
+
+    with db.engine.connect() as conn:
+        linhas = conn.exec_driver_sql(prefixo + sql).all()
+
+    return "\n".join(" ".join(str(c) for c in linha) for linha in linhas)
+
+@app.cli.command("verificar-indices")
+def verificar_indices_cmd():
+
+    falhas = 0
+
+    for descricao, indice, consulta in CONSULTAS_QUENTES:
+
+        plano = plano_de_execucao(consulta())
+
+        if indice in plano:
+            print(f"OK     {descricao} → {indice}")
+        else:
+            falhas += 1
+            print(f"FALTA  {descricao} → {indice}")
+            print("       " + plano.replace("\n", "\n       "))
+
+    if falhas:
+        raise SystemExit(1)
+
+# ================= CRIAR TABELAS =================
+with app.app_context():
+    db.create_all()
+    aplicar_migracoes()
+# ================= CONFIG CÓDIGOS =================
+SIGN_SECRET = b"recuperacao-super-secreta"
+CODE_EXPIRATION = 300  # 5 minutos
+
+# ================= CACHE =================
+class CacheTTL:
+    """
+    Cache em memória, por processo, com expiração (ttl em segundos)
+    e limite de entradas (sai a menos usada).
+    """
+
+    def __init__(self, ttl, maximo=10000):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave, padrao=None):
+        with self._lock:
+            item = self._dados.get(chave)
+
+            if item is None:
+                return padrao
+
+            valor, expira = item
+
+            if expira < time.monotonic():
+                del self._dados[chave]
+                return padrao
+
+            self._dados.move_to_end(chave)
+            return valor
+
+    def set(self, chave, valor, ttl=None):
+        with self._lock:
+            self._dados[chave] = (valor, time.monotonic() + (ttl or self.ttl))
+            self._dados.move_to_end(chave)
+
+            while len(self._dados) > self.maximo:
+                self._dados.popitem(last=False)
+
+    def delete(self, chave):
+        with self._lock:
+            self._dados.pop(chave, None)
+
+    def pop(self, chave, padrao=None):
+        """Lê e remove numa só operação."""
+        with self._lock:
+            valor, expira = self._dados.pop(chave, (padrao, None))
+
+            if expira is not None and expira < time.monotonic():
+                return padrao
+
+            return valor
+
+    def remover_onde(self, condicao):
+        """Remove as entradas cujo valor satisfaz condicao(valor)."""
+        with self._lock:
+            for chave in [c for c, (v, _) in self._dados.items() if condicao(v)]:
+                del self._dados[chave]
+
+    def clear(self):
+        with self._lock:
+            self._dados.clear()
+
+def depois_do_commit(func, *args, sessao_db=None):
+    """Corre func(*args) só se a transação atual fizer commit."""
+
+    info = (sessao_db or db.session).info
+    info.setdefault("depois_do_commit", []).append((func, args))
+
+def invalidar_apos_commit(func, *args, sessao_db=None):
+    """
+    Corre func(*args) já e outra vez depois do commit, para que um
+    pedido concorrente não volte a pôr em cache o estado antigo.
+    """
+
+    func(*args)
+    depois_do_commit(func, *args, sessao_db=sessao_db)
+
+@db.event.listens_for(db.session, "after_commit")
+def correr_depois_do_commit(sessao_db):
+    for func, args in sessao_db.info.pop("depois_do_commit", []):
+        func(*args)
+
+@db.event.listens_for(db.session, "after_rollback")
+def descartar_depois_do_commit(sessao_db):
+    sessao_db.info.pop("depois_do_commit", None)
+
+# ================= PASSWORDS =================
+# Os algoritmos vivem em hashing.py (importável pelos processos do pool).
+from hashing import HASHER_ATUAL, HasherSha256Legado, hasher_de, _gerar_hash, _verificar_hash
+
+# ================= POOL DE HASHING =================
+# scrypt/pbkdf2 custam dezenas de ms de CPU. Correm num pool de processos
+# limitado para não prenderem os workers do gunicorn. Se a fila encher
+# (ex.: tempestade de logins), o pedido recebe 503 em vez de esperar.
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+HASH_FILA_MAX = int(os.environ.get("PASSWORD_HASH_QUEUE", 16))
+HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+
+class HashingSobrecarregado(Exception):
+    pass
+
+_pool_hash = None
+_pool_hash_pid = None
+_pool_hash_lock = threading.Lock()
+_vagas_hash = threading.BoundedSemaphore(max(1, HASH_WORKERS + HASH_FILA_MAX))
+
+def pool_hash():
+    global _pool_hash, _pool_hash_pid
+
+    # depois de um fork (gunicorn --preload) o pool do pai não serve
+    with _pool_hash_lock:
+        if _pool_hash is None or _pool_hash_pid != os.getpid():
+            # forkserver: os processos do pool não herdam threads, locks nem
+            # ligações à BD deste worker; só importam hashing.py (com
+            # "python recuperadordecontas.py" importam também este módulo)
+            _pool_hash = ProcessPoolExecutor(
+                max_workers=HASH_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+            _pool_hash_pid = os.getpid()
+
+    return _pool_hash
+
+def executar_hash(func, *args):
+
+    # PASSWORD_HASH_WORKERS=0 → corre no próprio pedido
+    if HASH_WORKERS <= 0:
+        return func(*args)
+
+    if not _vagas_hash.acquire(blocking=False):
+        raise HashingSobrecarregado()
+
+    try:
+        return pool_hash().submit(func, *args).result(timeout=HASH_TIMEOUT)
+    except FuturesTimeout:
+        raise HashingSobrecarregado()
+    finally:
+        _vagas_hash.release()
+
+@app.errorhandler(HashingSobrecarregado)
+def hashing_sobrecarregado(e):
+    return jsonify(
+        status="error",
+        msg="Servidor ocupado, tenta novamente dentro de momentos"
+    ), 503, {"Retry-After": "2"}
+
+# ================= UTILS =================
+def hash_password(p):
+    return executar_hash(_gerar_hash, p)
+
+def verificar_password(password, guardado):
+
+    if not password or not guardado:
+        return False
+
+    hasher = hasher_de(guardado)
+
+    if hasher is None:
+        return False
+
+    # sha256 legado é barato, não vale a pena ir ao pool
+    if isinstance(hasher, HasherSha256Legado):
+        return _verificar_hash(password, guardado)
+
+    return executar_hash(_verificar_hash, password, guardado)
+
+def confirmar_password(user, password):
+    """
+    Verifica a password do utilizador. Se o hash estiver num algoritmo
+    ou com parâmetros antigos, substitui-o (fica gravado no próximo commit).
+    """
+
+    if not verificar_password(password, user.password):
+        return False
+
+    if (
+        hasher_de(user.password) is not HASHER_ATUAL
+        or not HASHER_ATUAL.parametros_atuais(user.password)
+    ):
+        user.password = hash_password(password)
+
+    return True
+
+def generate_code(tipo):
+    # 16 caracteres hex (compatível com o app)
+    return os.urandom(16).hex()
+
+def validate_code(token, tipo_esperado):
+    if (
+        not token
+        or len(token) != 32
+        or not all(c in "0123456789abcdef" for c in token.lower())
+    ):
+        return False, "Código inválido"
+
+    return True, "OK"
+
+def hash_resposta(resposta: str) -> str:
+    return hashlib.sha256(resposta.strip().lower().encode()).hexdigest()
+
+def bloqueios_de(user_id):
+    """
+    Ids com quem o utilizador tem um bloqueio, em qualquer sentido.
+    Uma única query por utilizador e por pedido (guardado em g), para
+    os ciclos filtrarem com um simples "in".
+    """
+
+    if not user_id:
+        return set()
+
+    user_id = int(user_id)
+    cache = g.setdefault("bloqueios", {})
+
+    if user_id not in cache:
+        cache[user_id] = {
+            outro for (outro,) in db.session.query(
+                db.case(
+                    (Block.blocker_id == user_id, Block.blocked_id),
+                    else_=Block.blocker_id
+                )
+            ).filter(
+                db.or_(
+                    Block.blocker_id == user_id,
+                    Block.blocked_id == user_id
+                )
+            )
+        }
+
+    return cache[user_id]
+
+def limpar_cache_bloqueios():
+    g.pop("bloqueios", None)
+
+# ================= IDENTIDADE =================
+# Um identificador (username, email ou email de recuperação) resolve-se
+# com uma só query sobre os índices lower(). Os valores são guardados já
+# normalizados (ver normalizar_identidade), por isso basta normalizar o
+# que vem do pedido da mesma forma.
+def resolver_identidade(identificador, campos=CAMPOS_IDENTIDADE):
+    """Devolve o User do identificador; em empate ganha a ordem de campos."""
+
+    identificador = normalizar_identidade(identificador or "")
+
+    if not identificador:
+        return None
+
+    condicoes = [
+        func.lower(getattr(User, campo)) == identificador
+        for campo in campos
+    ]
+
+    user = User.query.filter(
+        db.or_(*condicoes)
+    ).order_by(
+        db.case(
+            *[(cond, i) for i, cond in enumerate(condicoes)]
+        )
+    ).first()
+
+    return user
+
+# ================= SESSÕES (CACHE) =================
+# /check-session e /auto-login são chamados em ciclo pelos clientes.
+# Só as sessões ativas ficam em cache por token, e por pouco tempo.
+# A cache é por processo: cada worker invalida as suas entradas nos
+# eventos abaixo, mas um logout/ban feito noutro worker só se vê aqui
+# quando passa SESSION_CACHE_TTL, por isso este tem de ser curto.
+sessoes_cache = CacheTTL(
+    ttl=float(os.environ.get("SESSION_CACHE_TTL", 2)),
+    maximo=int(os.environ.get("SESSION_CACHE_MAX", 50000))
+)
+
+def estado_sessao(token):
+    """
+    Devolve o estado da sessão do token
+    ({"id", "active", "user_id", "user"}) ou None se não existir.
+    """
+
+    if not token:
+        return None
+
+    estado = sessoes_cache.get(token)
+
+    if estado is not None:
+        return estado
+
+    linha = db.session.query(
+        UserSession.id,
+        UserSession.active,
+        UserSession.user_id,
+        User.username,
+        User.avatar,
+        User.role
+    ).outerjoin(
+        User,
+        User.id == UserSession.user_id
+    ).filter(
+        UserSession.session_token == token
+    ).first()
+
+    if not linha:
+        return None
+
+    estado = {
+        "id": linha.id,
+        "active": bool(linha.active),
+        "user_id": linha.user_id,
+        "user": {
+            "id": linha.user_id,
+            "username": linha.username,
+            "avatar": linha.avatar,
+            "role": linha.role
+        } if linha.username is not None else None
+    }
+
+    # sessões terminadas não vão para a cache: um token revogado
+    # nunca pode voltar a ser aceite a partir dela
+    if estado["active"]:
+        sessoes_cache.set(token, estado)
+
+    return estado
+
+def _invalidar_sessoes(token=None, user_id=None):
+
+    if token:
+        sessoes_cache.delete(token)
+
+    if user_id:
+        user_id = int(user_id)
+
+        sessoes_cache.remover_onde(
+            lambda e: e["user_id"] == user_id
+        )
+
+def invalidar_sessoes(token=None, user_id=None, sessao_db=None):
+    invalidar_apos_commit(
+        _invalidar_sessoes,
+        token,
+        user_id,
+        sessao_db=sessao_db
+    )
+
+@db.event.listens_for(UserSession.active, "set")
+def sessao_alterada(target, value, oldvalue, initiator):
+    invalidar_sessoes(
+        token=target.session_token,
+        sessao_db=db.object_session(target)
+    )
+
+@db.event.listens_for(User.username, "set")
+@db.event.listens_for(User.avatar, "set")
+@db.event.listens_for(User.role, "set")
+@db.event.listens_for(User.banido, "set")
+@db.event.listens_for(User.apagado, "set")
+def user_da_sessao_alterado(target, value, oldvalue, initiator):
+    if target.id:
+        invalidar_sessoes(
+            user_id=target.id,
+            sessao_db=db.object_session(target)
+        )
+
+@db.event.listens_for(User, "after_delete")
+def user_da_sessao_apagado(mapper, connection, target):
+    invalidar_sessoes(user_id=target.id, sessao_db=db.object_session(target))
+
+# ================= PERFIS (CACHE) =================
+# Parte do perfil que não depende de quem vê. Invalidada quando mudam
+# os campos do user (perfil, loja, privacidade, ban) ou os contadores
+# de seguidores; noutros workers PROFILE_CACHE_TTL limita o atraso.
+perfis_cache = CacheTTL(
+    ttl=int(os.environ.get("PROFILE_CACHE_TTL", 60)),
+    maximo=int(os.environ.get("PROFILE_CACHE_MAX", 20000))
+)
+
+def perfil_resumo(user_id):
+    """Devolve o resumo público do perfil ou None se não existir."""
+
+    perfil = perfis_cache.get(user_id)
+
+    if perfil is not None:
+        return perfil or None
+
+    user = db.session.query(
+        User.id,
+        User.nome,
+        User.username,
+        User.avatar,
+        User.banner,
+        User.bio,
+        User.apagado,
+        User.seguidores_total,
+        User.seguindo_total
+    ).filter(User.id == user_id).first()
+
+    if not user or user.apagado:
+        perfis_cache.set(user_id, False)
+        return None
+
+    perfil = {
+        "id": user.id,
+        "nome": user.nome,
+        "username": user.username,
+        "avatar": user.avatar,
+        "banner": user.banner,
+        "bio": user.bio,
+        "seguidores": user.seguidores_total,
+        "seguindo": user.seguindo_total
+    }
+
+    perfis_cache.set(user_id, perfil)
+
+    return perfil
+
+def invalidar_perfil(user_id, sessao_db=None):
+    if user_id:
+        invalidar_apos_commit(perfis_cache.delete, int(user_id), sessao_db=sessao_db)
+
+@db.event.listens_for(User.nome, "set")
+@db.event.listens_for(User.username, "set")
+@db.event.listens_for(User.avatar, "set")
+@db.event.listens_for(User.banner, "set")
+@db.event.listens_for(User.bio, "set")
+@db.event.listens_for(User.apagado, "set")
+@db.event.listens_for(User.banido, "set")
+@db.event.listens_for(User.perfil_privado, "set")
+@db.event.listens_for(User.mostrar_nome, "set")
+@db.event.listens_for(User.mostrar_publicamente, "set")
+def perfil_alterado(target, value, oldvalue, initiator):
+    if target.id:
+        invalidar_perfil(target.id, sessao_db=db.object_session(target))
+
+@db.event.listens_for(User, "after_insert")
+@db.event.listens_for(User, "after_delete")
+def perfil_criado_ou_apagado(mapper, connection, target):
+    # um id inexistente pode estar em cache como "não existe"
+    invalidar_perfil(target.id, sessao_db=db.object_session(target))
+
+# ================= TICKETS (TEMPO REAL) =================
+# Cada janela de ticket aberta subscreve uma fila do seu ticket. As
+# mensagens novas são publicadas depois do commit, venham de onde vierem
+# (ver eventos de TicketMessage). Com vários workers a mensagem só chega
+# logo aos subscritores do mesmo processo; os outros apanham-na na
+# consulta à base de dados feita a cada TICKET_STREAM_POLL segundos.
+#
+# Cada stream ocupa uma thread do worker, por isso há no máximo
+# TICKET_STREAM_MAX por processo; acima disso a página recebe 503 e
+# passa a fazer polling a /messages/live.
+TICKET_STREAM_HEARTBEAT = float(os.environ.get("TICKET_STREAM_HEARTBEAT", 15))
+TICKET_STREAM_POLL = float(os.environ.get("TICKET_STREAM_POLL", 2))
+TICKET_STREAM_DURACAO = float(os.environ.get("TICKET_STREAM_MAX_SECONDS", 300))
+TICKET_STREAM_MAX = int(os.environ.get("TICKET_STREAM_MAX", 4))
+
+vagas_streams_tickets = threading.BoundedSemaphore(max(1, TICKET_STREAM_MAX))
+
+class CanalTickets:
+
+    def __init__(self, tamanho_fila=100):
+        self.tamanho_fila = tamanho_fila
+        self._filas = {}
+        self._lock = threading.Lock()
+
+    def subscrever(self, ticket_id):
+        fila = queue.Queue(maxsize=self.tamanho_fila)
+
+        with self._lock:
+            self._filas.setdefault(ticket_id, set()).add(fila)
+
+        return fila
+
+    def cancelar(self, ticket_id, fila):
+        with self._lock:
+            filas = self._filas.get(ticket_id)
+
+            if filas is not None:
+                filas.discard(fila)
+
+                if not filas:
+                    del self._filas[ticket_id]
+
+    def publicar(self, ticket_id, mensagem):
+        with self._lock:
+            filas = list(self._filas.get(ticket_id, ()))
+
+        for fila in filas:
+            try:
+                fila.put_nowait(mensagem)
+            except queue.Full:
+                # cliente lento: recupera pela base de dados no heartbeat
+                pass
+
+canal_tickets = CanalTickets()
+
+def mensagem_ticket_json(m):
+    return {
+        "id": m.id,
+        "sender": m.sender,
+        "message": m.message
+    }
+
+@db.event.listens_for(TicketMessage, "after_insert")
+def mensagem_ticket_inserida(mapper, connection, target):
+    sessao_db = db.object_session(target)
+    sessao_db.info.setdefault("tickets_publicar", []).append(
+        (target.ticket_id, mensagem_ticket_json(target))
+    )
+
+@db.event.listens_for(db.session, "after_commit")
+def tickets_apos_commit(sessao_db):
+    for ticket_id, mensagem in sessao_db.info.pop("tickets_publicar", []):
+        canal_tickets.publicar(ticket_id, mensagem)
+
+@db.event.listens_for(db.session, "after_rollback")
+def tickets_apos_rollback(sessao_db):
+    sessao_db.info.pop("tickets_publicar", None)
+
+def existe_bloqueio(a, b):
+    if not a or not b:
+        return False
+
+    cache = g.get("bloqueios", {})
+
+    # já carregado neste pedido → sem query
+    if int(a) in cache:
+        return int(b) in cache[int(a)]
+
+    if int(b) in cache:
+        return int(a) in cache[int(b)]
+
+    return db.session.query(Block.id).filter(
+        db.or_(
+            db.and_(Block.blocker_id == a, Block.blocked_id == b),
+            db.and_(Block.blocker_id == b, Block.blocked_id == a)
+        )
+    ).first() is not None
+
+# ================= TAREFAS PERIÓDICAS =================
+_tarefas = {}
+_tarefas_lock = threading.Lock()
+
+def obter_lease(nome, duracao):
+    """
+    Tenta ficar com a tarefa `nome` durante `duracao` segundos, entre
+    todos os workers/máquinas que usam a mesma base de dados.
+    """
+
+    agora = datetime.utcnow()
+    tabela = TarefaLease.__table__
+    valores = dict(
+        dono=str(os.getpid()),
+        ate=agora + timedelta(seconds=duracao)
+    )
+
+    with db.engine.begin() as conn:
+        apanhada = conn.execute(
+            tabela.update().where(
+                tabela.c.nome == nome,
+                tabela.c.ate < agora
+            ).values(**valores)
+        ).rowcount
+
+    if apanhada:
+        return True
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(tabela.insert(), dict(nome=nome, **valores))
+    except IntegrityError:
+        # outro processo tem a lease ainda válida
+        return False
+
+    return True
+
+def tarefa_periodica(nome, intervalo, func, exclusiva=False):
+    """
+    Corre func (com app context) de intervalo em intervalo numa thread
+    daemon. Arranca uma só vez por processo; depois de um fork do
+    gunicorn cada worker arranca a sua na primeira chamada.
+    Com exclusiva=True, em cada intervalo só um dos processos a corre
+    (ver obter_lease).
+    """
+
+    chave = (nome, os.getpid())
+
+    with _tarefas_lock:
+
+        if chave in _tarefas:
+            return
+
+        def ciclo():
+            while True:
+                time.sleep(intervalo)
+
+                try:
+                    with app.app_context():
+                        if not exclusiva or obter_lease(nome, intervalo * 0.9):
+                            func()
+                except Exception as e:
+                    print("ERRO NA TAREFA", nome, e)
+
+        t = threading.Thread(target=ciclo, name=nome, daemon=True)
+        t.start()
+
+        _tarefas[chave] = t
+
+# ================= ATIVIDADE DA CONTA =================
+# ACTIVITY_LOG_MODE:
+#   transacao → a linha entra no commit do próprio pedido (durável,
+#               sem commit extra)
+#   buffer    → as linhas ficam em memória e são gravadas em lote quando
+#               chegam a ACTIVITY_LOG_BATCH ou passam ACTIVITY_LOG_INTERVAL
+#               segundos; um crash pode perder o último lote
+MODO_ATIVIDADE = os.environ.get("ACTIVITY_LOG_MODE", "transacao")
+ATIVIDADE_LOTE = int(os.environ.get("ACTIVITY_LOG_BATCH", 100))
+ATIVIDADE_INTERVALO = float(os.environ.get("ACTIVITY_LOG_INTERVAL", 2))
+
+class BufferAtividade:
+
+    def __init__(self, lote, intervalo):
+        self.lote = lote
+        self.intervalo = intervalo
+        self._linhas = []
+        self._desde = None
+        self._lock = threading.Lock()
+
+    def adicionar(self, linha):
+        with self._lock:
+            if not self._linhas:
+                self._desde = time.monotonic()
+
+            self._linhas.append(linha)
+
+    def deve_gravar(self):
+        with self._lock:
+            return bool(self._linhas) and (
+                len(self._linhas) >= self.lote
+                or time.monotonic() - self._desde >= self.intervalo
+            )
+
+    def gravar(self):
+        with self._lock:
+            linhas, self._linhas = self._linhas, []
+
+        if not linhas:
+            return
+
+        try:
+            # ligação própria: não mistura com a sessão do pedido
+            with db.engine.begin() as conn:
+                conn.execute(AccountActivity.__table__.insert(), linhas)
+        except Exception as e:
+            print("ERRO A GRAVAR ATIVIDADE:", e)
+
+            with self._lock:
+                self._linhas[:0] = linhas
+                self._desde = time.monotonic()
+
+buffer_atividade = BufferAtividade(ATIVIDADE_LOTE, ATIVIDADE_INTERVALO)
+
+def adicionar_atividade(
+        user_id,
+        tipo,
+        descricao,
+        antigo="",
+        novo="",
+        origem="user",
+        admin_id=None
+):
+
+    linha = dict(
+
+        user_id=user_id,
+
+        admin_id=admin_id,
+
+        activity_type=tipo,
+
+        description=descricao,
+
+        old_value=antigo,
+
+        new_value=novo,
+
+        origem=origem,
+
+        created_at=datetime.utcnow()
+
+    )
+
+    if MODO_ATIVIDADE == "buffer":
+        buffer_atividade.adicionar(linha)
+        tarefa_periodica("atividade", ATIVIDADE_INTERVALO, gravar_atividade)
+        return
+
+    # gravada pelo commit de quem chamou
+    db.session.add(AccountActivity(**linha))
+
+def gravar_atividade():
+    if buffer_atividade.deve_gravar():
+        buffer_atividade.gravar()
+
+@app.teardown_request
+def gravar_atividade_no_fim(exc):
+    gravar_atividade()
+
+@atexit.register
+def gravar_atividade_ao_sair():
+    with app.app_context():
+        buffer_atividade.gravar()
+
+# ================= RETENÇÃO DE NOTIFICAÇÕES =================
+# Notificações lidas com mais de NOTIFICATIONS_RETENTION_DAYS dias são
+# apagadas em lotes pequenos (transações curtas), de hora a hora por
+# omissão, por um só worker de cada vez (lease em tarefas_lease).
+# NOTIFICATIONS_RETENTION_INTERVAL=0 desliga a tarefa; a limpeza pode
+# então correr por cron com "flask limpar-notificacoes".
+RETENCAO_NOTIFICACOES_DIAS = int(os.environ.get("NOTIFICATIONS_RETENTION_DAYS", 90))
+RETENCAO_NOTIFICACOES_LOTE = int(os.environ.get("NOTIFICATIONS_RETENTION_BATCH", 1000))
+RETENCAO_NOTIFICACOES_INTERVALO = float(os.environ.get("NOTIFICATIONS_RETENTION_INTERVAL", 3600))
+
+def limpar_notificacoes_antigas(dias=None):
+    """Apaga notificações lidas antigas. Devolve quantas apagou."""
+
+    limite = datetime.utcnow() - timedelta(
+        days=RETENCAO_NOTIFICACOES_DIAS if dias is None else dias
+    )
+
+    total = 0
+
+    while True:
+        ids = [
+            nid for (nid,) in db.session.query(Notification.id).filter(
+                Notification.lida == True,
+                Notification.data < limite
+            ).limit(RETENCAO_NOTIFICACOES_LOTE)
+        ]
+
+        if not ids:
+            break
+
+        # lidas → não mexem nos contadores por ler
+        Notification.query.filter(
+            Notification.id.in_(ids)
+        ).delete(synchronize_session=False)
+
+        db.session.commit()
+
+        total += len(ids)
+
+        if len(ids) < RETENCAO_NOTIFICACOES_LOTE:
+            break
+
+    return total
+
+@app.before_request
+def arrancar_retencao_notificacoes():
+    if RETENCAO_NOTIFICACOES_INTERVALO > 0:
+        tarefa_periodica(
+            "retencao-notificacoes",
+            RETENCAO_NOTIFICACOES_INTERVALO,
+            limpar_notificacoes_antigas,
+            exclusiva=True
+        )
+
+@app.cli.command("limpar-notificacoes")
+def limpar_notificacoes_cmd():
+    print("Notificações apagadas:", limpar_notificacoes_antigas())
+
+def is_admin(user_id):
+
+    if not user_id:
+        return False
+
+    user = User.query.get(user_id)
+
+    if not user:
+        return False
+
+    return user.id == 1 or user.role == "admin"
+
+def admin_required(user_id):
+    user = User.query.get(user_id)
+    if not user or user.role != "admin":
+        return False, jsonify(error="Sem permissão"), 403
+    return True, user
+
+def admin_ticket_required(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        user_id = session.get("user_id")
+
+        if not user_id:
+            return jsonify(error="Sessão inválida"), 401
+
+        if not is_admin(user_id):
+            return jsonify(error="Sem permissão"), 403
+
+        return func(*args, **kwargs)
+
+    return wrapper
+# ================= ROTAS PÁGINAS =================
+@app.route("/")
+def home():
+    return render_template("index.html")
+
+@app.route("/recover-password")
+def recover_password():
+    return render_template("recover_password.html")
+
+@app.route("/recover-username")
+def recover_username():
+    return render_template("recover_username.html")
+    
+# ================= API GERAR CÓDIGOS =================
+@app.route("/api/generate-password-code", methods=["GET"])
+def generate_password_code():
+    token = generate_code("password")
+    return jsonify(status="ok", token=token, expires=CODE_EXPIRATION)
+
+@app.route("/api/generate-username-code", methods=["GET"])
+def generate_username_code():
+    token = generate_code("username")
+    return jsonify(status="ok", token=token, expires=CODE_EXPIRATION)
+
+# ================= API VALIDAR CÓDIGOS =================
+@app.route("/api/validate-password-code", methods=["POST"])
+def validate_password_code():
+    data = request.get_json(silent=True) or {}
+    code = (data.get("code") or "").strip()
+
+    ok, msg = validate_code(code, "password")
+    if not ok:
+        return jsonify(status="error", msg=msg)
+
+    return jsonify(status="ok")
+
+@app.route("/api/validate-username-code", methods=["POST"])
+def validate_username_code():
+    data = request.get_json(silent=True) or {}
+    code = (data.get("code") or "").strip()
 
     ok, msg = validate_code(code, "username")
     if not ok:
@@ -1223,16 +2974,12 @@ def login():
     if not identificador or not password:
         return jsonify(status="error", msg="Dados inválidos"), 400
 
-    user = (
-        User.query.filter_by(username=identificador).first()
-        or User.query.filter_by(email=identificador).first()
-        or User.query.filter_by(email_recuperacao=identificador).first()
-    )
+    user = resolver_identidade(identificador)
 
     if not user:
         return jsonify(status="error", msg="Utilizador não encontrado"), 404
 
-    if user.password != hash_password(password):
+    if not confirmar_password(user, password):
         return jsonify(status="error", msg="Password inválida"), 401
 
     if user.apagado:
@@ -1328,7 +3075,7 @@ def delete_account():
         ), 404
 
     # Verificar password
-    if hash_password(password) != user.password:
+    if not verificar_password(password, user.password):
         return jsonify(
             status="error",
             msg="Password incorreta"
@@ -1404,9 +3151,9 @@ def get_recovery_questions():
     data = request.get_json(force=True)
     email = (data.get("email") or "").strip().lower()
 
-    user = (
-        User.query.filter_by(email=email).first()
-        or User.query.filter_by(email_recuperacao=email).first()
+    user = resolver_identidade(
+        email,
+        campos=("email", "email_recuperacao")
     )
 
     if not user or not user.perguntas_recuperacao:
@@ -1427,9 +3174,9 @@ def validate_recovery_answers():
     email = (data.get("email") or "").strip().lower()
     respostas = data.get("respostas", [])
 
-    user = (
-        User.query.filter_by(email=email).first()
-        or User.query.filter_by(email_recuperacao=email).first()
+    user = resolver_identidade(
+        email,
+        campos=("email", "email_recuperacao")
     )
 
     if not user or not user.perguntas_recuperacao:
@@ -1470,44 +3217,187 @@ def check_recovery_email():
         email_principal=user.email
     )
 
-#================= POSTS LIST =================
-@app.route("/posts", methods=["GET"])
-def listar_posts():
+#================= PAGINAÇÃO (CURSOR) =================
+FEED_LIMITE_PADRAO = 20
+FEED_LIMITE_MAXIMO = 100
 
-    posts = Post.query.order_by(Post.data.desc()).all()
+def ler_cursor(valor):
+    """Lê um cursor "<data ISO>,<id>" e devolve (data, id) ou None."""
 
-    res = []
+    if not valor:
+        return None
 
-    for p in posts:
+    data, _, item_id = valor.partition(",")
 
-        autor = User.query.get(p.autor_id)
+    if not item_id:
+        raise ValueError("cursor sem id")
 
-        if not autor:
-            continue
+    return datetime.fromisoformat(data), item_id
 
-        real_id = p.original_post_id or p.id
+def gerar_cursor(data, item_id):
+    return f"{data.isoformat()},{item_id}"
+
+def ler_limite(padrao=FEED_LIMITE_PADRAO, maximo=FEED_LIMITE_MAXIMO):
+    limite = request.args.get("limit", padrao, type=int)
+    return max(1, min(limite, maximo))
+
+def ler_limite_compativel(*cursores, padrao=FEED_LIMITE_PADRAO, maximo=FEED_LIMITE_MAXIMO):
+    """
+    Como ler_limite, mas sem ?limit= nem nenhum dos cursores devolve None
+    (lista completa, como antes da paginação): os clientes antigos não
+    conhecem o X-Next-Cursor e não teriam como chegar ao resto.
+    """
+
+    if "limit" in request.args or any(c in request.args for c in cursores):
+        return ler_limite(padrao, maximo)
 
-        # ================= IMAGENS =================
+    return None
 
-        imagens = []
+def paginar_keyset(query, coluna_data, coluna_id, limite, parametro="before"):
+    """
+    Pagina por (data, id). Com ?before= devolve do mais recente para o
+    mais antigo; com ?after= do mais antigo para o mais recente.
+    Devolve (itens, proximo_cursor). Com limite None devolve tudo.
+    """
 
-        for img in PostImage.query.filter_by(post_id=p.id).all():
+    cursor = ler_cursor(request.args.get(parametro))
 
-            imagens.append(
-                request.host_url.rstrip("/") + img.caminho
+    if parametro == "before":
+        depois = lambda col, valor: col < valor
+        ordem = (coluna_data.desc(), coluna_id.desc())
+    else:
+        depois = lambda col, valor: col > valor
+        ordem = (coluna_data.asc(), coluna_id.asc())
+
+    if cursor:
+        data, item_id = cursor
+        query = query.filter(
+            db.or_(
+                depois(coluna_data, data),
+                db.and_(coluna_data == data, depois(coluna_id, item_id))
             )
+        )
 
-        # ================= FICHEIROS =================
+    if limite is None:
+        return query.order_by(*ordem).all(), None
 
-        ficheiros = []
+    itens = query.order_by(*ordem).limit(limite + 1).all()
 
-        for f in PostFile.query.filter_by(post_id=p.id).all():
+    proximo = None
 
-            ficheiros.append({
-                "id": f.id,
-                "nome": f.nome,
-                "url": request.host_url.rstrip("/") + f.caminho
-            })
+    if len(itens) > limite:
+        itens = itens[:limite]
+        proximo = gerar_cursor(itens[-1].data, itens[-1].id)
+
+    return itens, proximo
+
+def paginar_posts(query, limite):
+    """Aplica o cursor ?before= (data, id) e devolve (posts, proximo_cursor)."""
+    return paginar_keyset(query, Post.data, Post.id, limite)
+
+def serializar_posts(posts):
+    """
+    Serializa uma página de posts com um número fixo de queries:
+    autores, imagens e ficheiros são carregados para a página inteira
+    de uma vez e as contagens vêm dos contadores do post.
+    """
+
+    if not posts:
+        return []
+
+    base_url = request.host_url.rstrip("/")
+
+    ids = [p.id for p in posts]
+    reais = {p.original_post_id or p.id for p in posts}
+
+    # ================= AUTORES =================
+
+    autores = {
+        a.id: a
+        for a in db.session.query(
+            User.id,
+            User.username,
+            User.avatar
+        ).filter(
+            User.id.in_({p.autor_id for p in posts})
+        )
+    }
+
+    # ================= IMAGENS =================
+
+    imagens = {}
+    variantes = {}
+
+    for img in db.session.query(
+        PostImage.post_id,
+        PostImage.caminho,
+        PostImage.miniatura,
+        PostImage.caminho_feed
+    ).filter(
+        PostImage.post_id.in_(ids)
+    ).order_by(PostImage.id):
+
+        imagens.setdefault(img.post_id, []).append(
+            base_url + img.caminho
+        )
+
+        # sem variantes (ainda) → o original
+        variantes.setdefault(img.post_id, []).append({
+            "original": base_url + img.caminho,
+            "feed": base_url + (img.caminho_feed or img.caminho),
+            "miniatura": base_url + (img.miniatura or img.caminho)
+        })
+
+    # ================= FICHEIROS =================
+
+    ficheiros = {}
+
+    for f in db.session.query(
+        PostFile.id,
+        PostFile.post_id,
+        PostFile.nome,
+        PostFile.caminho
+    ).filter(
+        PostFile.post_id.in_(ids)
+    ).order_by(PostFile.id):
+
+        ficheiros.setdefault(f.post_id, []).append({
+            "id": f.id,
+            "nome": f.nome,
+            "url": base_url + f.caminho
+        })
+
+    # ================= CONTAGENS =================
+    # Os contadores vivem no post original; só os reposts precisam
+    # de ir buscar o original.
+
+    contadores = {
+        p.id: (p.total_likes, p.total_comentarios)
+        for p in posts
+    }
+
+    originais = reais - contadores.keys()
+
+    if originais:
+        for o in db.session.query(
+            Post.id,
+            Post.total_likes,
+            Post.total_comentarios
+        ).filter(
+            Post.id.in_(originais)
+        ):
+            contadores[o.id] = (o.total_likes, o.total_comentarios)
+
+    res = []
+
+    for p in posts:
+
+        autor = autores.get(p.autor_id)
+
+        if not autor:
+            continue
+
+        real_id = p.original_post_id or p.id
 
         res.append({
 
@@ -1518,19 +3408,17 @@ def listar_posts():
             "formatacao": p.formatacao,
 
             # <-- lista de imagens
-            "imagens": imagens,
+            "imagens": imagens.get(p.id, []),
+
+            "imagens_variantes": variantes.get(p.id, []),
 
-            "ficheiros": ficheiros,
+            "ficheiros": ficheiros.get(p.id, []),
 
             "data": p.data.strftime("%d/%m/%Y %H:%M"),
 
-            "likes": Like.query.filter_by(
-                post_id=real_id
-            ).count(),
+            "likes": contadores.get(real_id, (0, 0))[0],
 
-            "comentarios": Comment.query.filter_by(
-                post_id=real_id
-            ).count(),
+            "comentarios": contadores.get(real_id, (0, 0))[1],
 
             "autor": {
 
@@ -1544,14 +3432,601 @@ def listar_posts():
 
         })
 
-    return jsonify(res)
+    return res
+
+def resposta_paginada(res, proximo):
+    resposta = jsonify(res)
+
+    if proximo:
+        resposta.headers["X-Next-Cursor"] = proximo
+
+    return resposta
+
+#================= POSTS LIST =================
+@app.route("/posts", methods=["GET"])
+def listar_posts():
+
+    # ?before=<data,id>&limit=N (sem nenhum dos dois: o feed todo)
+    try:
+        posts, proximo = paginar_posts(
+            Post.query,
+            ler_limite_compativel("before")
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    return resposta_paginada(
+        serializar_posts(posts),
+        proximo
+    )
+
+#================= TIMELINE (A SEGUIR) =================
+# Fan-out na escrita: cada post novo é copiado (uma só query
+# INSERT ... SELECT) para a timeline de quem segue o autor, e a leitura
+# é um intervalo de timeline_entries. Exceções:
+#   - autores com mais de TIMELINE_FANOUT_MAX seguidores não são copiados;
+#     os seus posts (e os do próprio leitor) são lidos na hora (pull);
+#   - timelines não lidas há TIMELINE_INATIVA_DIAS deixam de receber
+#     posts e são reconstruídas na próxima leitura, tal como depois de
+#     seguir/deixar de seguir alguém;
+#   - o excesso acima de TIMELINE_TAMANHO é apagado por uma tarefa
+#     periódica (cortar_timelines_grandes), não no pedido do post.
+TIMELINE_TAMANHO = int(os.environ.get("TIMELINE_SIZE", 800))
+TIMELINE_FANOUT_MAX = int(os.environ.get("TIMELINE_FANOUT_MAX", 5000))
+TIMELINE_INATIVA_DIAS = int(os.environ.get("TIMELINE_INACTIVE_DAYS", 7))
+
+# as timelines crescem entre cortes; o corte corre fora dos pedidos
+TIMELINE_CORTE_INTERVALO = float(os.environ.get("TIMELINE_TRIM_INTERVAL", 600))
+
+def timelines_ativas_desde():
+    return datetime.utcnow() - timedelta(days=TIMELINE_INATIVA_DIAS)
+
+def invalidar_timelines(user_ids):
+    """A timeline destes users é reconstruída na próxima leitura."""
+
+    if not user_ids:
+        return
+
+    TimelineEstado.query.filter(
+        TimelineEstado.user_id.in_(user_ids)
+    ).delete(synchronize_session=False)
+
+    TimelineEntry.query.filter(
+        TimelineEntry.user_id.in_(user_ids)
+    ).delete(synchronize_session=False)
+
+def cortar_timeline(user_id):
+    """Apaga o que passa das TIMELINE_TAMANHO entradas mais recentes."""
+
+    corte = db.session.query(
+        TimelineEntry.data,
+        TimelineEntry.post_id
+    ).filter(
+        TimelineEntry.user_id == user_id
+    ).order_by(
+        TimelineEntry.data.desc(),
+        TimelineEntry.post_id.desc()
+    ).offset(TIMELINE_TAMANHO).first()
+
+    if not corte:
+        return 0
+
+    return TimelineEntry.query.filter(
+        TimelineEntry.user_id == user_id,
+        db.or_(
+            TimelineEntry.data < corte.data,
+            db.and_(
+                TimelineEntry.data == corte.data,
+                TimelineEntry.post_id <= corte.post_id
+            )
+        )
+    ).delete(synchronize_session=False)
+
+def cortar_timelines_grandes():
+    """
+    Tarefa periódica: corta só as timelines que passaram do tamanho,
+    uma transação curta por user (fora dos pedidos que publicam posts).
+    """
+
+    grandes = [
+        user_id for (user_id,) in db.session.query(
+            TimelineEntry.user_id
+        ).group_by(
+            TimelineEntry.user_id
+        ).having(
+            func.count(TimelineEntry.id) > TIMELINE_TAMANHO
+        )
+    ]
+
+    for user_id in grandes:
+        cortar_timeline(user_id)
+        db.session.commit()
+
+    return len(grandes)
+
+@app.before_request
+def arrancar_corte_timelines():
+    if TIMELINE_CORTE_INTERVALO > 0:
+        tarefa_periodica(
+            "corte-timelines",
+            TIMELINE_CORTE_INTERVALO,
+            cortar_timelines_grandes,
+            exclusiva=True
+        )
+
+def distribuir_post(post, autor):
+    """Copia o post para as timelines ativas de quem segue o autor."""
+
+    if autor.seguidores_total > TIMELINE_FANOUT_MAX:
+        return
+
+    # a data do post só é preenchida no INSERT
+    db.session.flush()
+
+    seguidores = db.session.query(
+        Follow.follower_id
+    ).join(
+        TimelineEstado,
+        TimelineEstado.user_id == Follow.follower_id
+    ).filter(
+        Follow.followed_id == autor.id,
+        TimelineEstado.lida_em >= timelines_ativas_desde()
+    )
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ["user_id", "post_id", "autor_id", "data"],
+            seguidores.with_entities(
+                Follow.follower_id,
+                db.literal(post.id),
+                db.literal(autor.id),
+                db.literal(post.data, db.DateTime)
+            )
+        )
+    )
+
+def construir_timeline(user_id):
+    """Reconstrói a timeline a partir de follows × posts (só quando preciso)."""
+
+    TimelineEntry.query.filter_by(
+        user_id=user_id
+    ).delete(synchronize_session=False)
+
+    recentes = db.session.query(
+        db.literal(user_id),
+        Post.id,
+        Post.autor_id,
+        Post.data
+    ).join(
+        Follow,
+        Follow.followed_id == Post.autor_id
+    ).join(
+        User,
+        User.id == Post.autor_id
+    ).filter(
+        Follow.follower_id == user_id,
+        User.seguidores_total <= TIMELINE_FANOUT_MAX
+    ).order_by(
+        Post.data.desc(),
+        Post.id.desc()
+    ).limit(TIMELINE_TAMANHO)
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ["user_id", "post_id", "autor_id", "data"],
+            recentes
+        )
+    )
+
+    agora = datetime.utcnow()
+
+    estado = db.session.get(TimelineEstado, user_id)
+
+    if not estado:
+        estado = TimelineEstado(user_id=user_id)
+        db.session.add(estado)
+
+    estado.construida_em = agora
+    estado.lida_em = agora
+
+def preparar_timeline(user_id):
+    """Garante que a timeline está completa antes de a ler."""
+
+    estado = db.session.get(TimelineEstado, user_id)
+
+    if not estado or estado.lida_em < timelines_ativas_desde():
+        construir_timeline(user_id)
+        db.session.commit()
+
+    # marcar como lida no máximo uma vez por hora
+    elif estado.lida_em < datetime.utcnow() - timedelta(hours=1):
+        estado.lida_em = datetime.utcnow()
+        db.session.commit()
+
+@app.route("/timeline/<int:user_id>", methods=["GET"])
+def timeline(user_id):
+
+    # ?before=<data,id>&limit=N (mesmo cursor do feed)
+    limite = ler_limite()
+
+    preparar_timeline(user_id)
+
+    try:
+        empurrados, mais_empurrados = paginar_keyset(
+            db.session.query(
+                TimelineEntry.post_id.label("id"),
+                TimelineEntry.data
+            ).filter(
+                TimelineEntry.user_id == user_id
+            ),
+            TimelineEntry.data,
+            TimelineEntry.post_id,
+            limite
+        )
+
+        # pull: autores com demasiados seguidores + o próprio leitor
+        autores_pull = db.session.query(
+            Follow.followed_id
+        ).join(
+            User,
+            User.id == Follow.followed_id
+        ).filter(
+            Follow.follower_id == user_id,
+            User.seguidores_total > TIMELINE_FANOUT_MAX
+        ).union(
+            db.session.query(db.literal(user_id))
+        )
+
+        puxados, mais_puxados = paginar_keyset(
+            db.session.query(
+                Post.id,
+                Post.data
+            ).filter(
+                Post.autor_id.in_(autores_pull)
+            ),
+            Post.data,
+            Post.id,
+            limite
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    # junta as duas listas (já ordenadas) e corta na página
+    vistos = set()
+    pagina = []
+
+    for item in sorted(
+        empurrados + puxados,
+        key=lambda i: (i.data, i.id),
+        reverse=True
+    ):
+        if item.id not in vistos:
+            vistos.add(item.id)
+            pagina.append(item)
+
+    proximo = None
+
+    if len(pagina) > limite or mais_empurrados or mais_puxados:
+        pagina = pagina[:limite]
+        proximo = gerar_cursor(pagina[-1].data, pagina[-1].id)
+
+    posts = {
+        p.id: p
+        for p in Post.query.filter(Post.id.in_([i.id for i in pagina]))
+    }
+
+    # posts apagados entretanto simplesmente não aparecem
+    return resposta_paginada(
+        serializar_posts([posts[i.id] for i in pagina if i.id in posts]),
+        proximo
+    )
+#================= UPLOADS =================
+# Os ficheiros são copiados em blocos para um temporário na pasta de
+# destino (calculando o sha256 pelo caminho), sincronizados para disco e
+# só depois renomeados (os.replace é atómico) para "<sha256><ext>".
+# Conteúdo repetido reaproveita o ficheiro que já existe.
+# Tudo isto acontece ANTES de se escrever na BD, para não segurar o lock
+# de escrita do SQLite enquanto se recebem/gravam ficheiros grandes.
+UPLOAD_MAX_FICHEIRO = int(os.environ.get("UPLOAD_MAX_FILE_MB", 15)) * 1024 * 1024
+UPLOAD_BLOCO = 64 * 1024
+
+# tipo detetado pelos primeiros bytes → extensão guardada
+ASSINATURAS = [
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"%PDF-", ".pdf"),
+]
+
+IMAGENS_PERMITIDAS = {".png", ".jpg", ".webp", ".gif"}
+
+# servidos a partir do nosso domínio: podiam correr scripts
+EXTENSOES_PROIBIDAS = {
+    ".html", ".htm", ".xhtml", ".svg", ".js", ".mjs", ".xml", ".php"
+}
+
+class UploadInvalido(Exception):
+    pass
+
+@app.errorhandler(UploadInvalido)
+def upload_invalido(e):
+    return jsonify(error=str(e)), 400
+
+@app.errorhandler(RequestEntityTooLarge)
+def pedido_demasiado_grande(e):
+    return jsonify(error="Pedido demasiado grande"), 413
+
+def detetar_extensao(cabecalho):
+    if cabecalho[:4] == b"RIFF" and cabecalho[8:12] == b"WEBP":
+        return ".webp"
+
+    for assinatura, extensao in ASSINATURAS:
+        if cabecalho.startswith(assinatura):
+            return extensao
+
+    return None
+
+def extensao_upload(cabecalho, nome_original, so_imagens):
+    extensao = detetar_extensao(cabecalho)
+
+    if so_imagens:
+        if extensao not in IMAGENS_PERMITIDAS:
+            raise UploadInvalido("Imagem inválida")
+        return extensao
+
+    if extensao:
+        return extensao
+
+    # tipo desconhecido: fica a extensão original, se for segura
+    extensao = os.path.splitext(nome_original or "")[1].lower()
+
+    if extensao in EXTENSOES_PROIBIDAS:
+        raise UploadInvalido("Tipo de ficheiro não permitido")
+
+    if not extensao[1:].isalnum() or len(extensao) > 10:
+        return ""
+
+    return extensao
+
+def receber_upload(file, destino, so_imagens=False):
+    """
+    Copia um FileStorage para um temporário em `destino`, validando-o.
+    Devolve (temporário, nome final "<sha256><ext>").
+    """
+
+    fd, temporario = tempfile.mkstemp(dir=destino, prefix=".upload-")
+
+    sha = hashlib.sha256()
+    tamanho = 0
+    extensao = None
+
+    try:
+        with os.fdopen(fd, "wb") as saida:
+
+            while True:
+                bloco = file.stream.read(UPLOAD_BLOCO)
+
+                if not bloco:
+                    break
+
+                if extensao is None:
+                    extensao = extensao_upload(bloco, file.filename, so_imagens)
+
+                tamanho += len(bloco)
+
+                if tamanho > UPLOAD_MAX_FICHEIRO:
+                    raise UploadInvalido(
+                        f"Ficheiro demasiado grande (máx. {UPLOAD_MAX_FICHEIRO // (1024 * 1024)} MB)"
+                    )
+
+                sha.update(bloco)
+                saida.write(bloco)
+
+            saida.flush()
+            os.fsync(saida.fileno())
+
+        if not tamanho:
+            raise UploadInvalido("Ficheiro vazio")
+
+    except BaseException:
+        os.remove(temporario)
+        raise
+
+    return temporario, sha.hexdigest() + extensao
+
+class LoteUploads:
+    """
+    Recebe os ficheiros de um pedido e só os publica (os.replace) se
+    todos forem válidos; se algum falhar, nenhum fica em static/.
+
+        with LoteUploads() as lote:
+            imagens = lote.receber(files, "posts", so_imagens=True)
+    """
+
+    def __init__(self):
+        self._pendentes = []
+
+    def receber(self, ficheiros, pasta, so_imagens=False, maximo=10):
+        """Valida até `maximo` ficheiros; devolve [(nome original, URL)]."""
+
+        destino = os.path.join("static", pasta)
+        os.makedirs(destino, exist_ok=True)
+
+        recebidos = []
+
+        for file in ficheiros[:maximo]:
+
+            if file.filename == "":
+                continue
+
+            temporario, nome = receber_upload(file, destino, so_imagens)
+
+            self._pendentes.append((temporario, os.path.join(destino, nome)))
+            recebidos.append((file.filename, f"/static/{pasta}/{nome}"))
+
+        return recebidos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, erro, tb):
+        for temporario, final in self._pendentes:
+
+            if tipo is None and not os.path.exists(final):
+                os.replace(temporario, final)
+            else:
+                # inválido, ou mesmo conteúdo já guardado
+                os.remove(temporario)
+
+        return False
+
+#================= IMAGENS (VARIANTES) =================
+# Depois do commit, cada imagem nova é reduzida num pool de threads
+# (o Pillow liberta o GIL a descodificar/redimensionar) para uma
+# miniatura e uma versão de feed em WebP, gravadas ao lado do original
+# em static/<pasta>/variantes/. Como os originais têm nome pelo sha256,
+# as variantes são partilhadas e as linhas são atualizadas pelo caminho.
+# Enquanto não existem, as respostas usam o original.
+IMAGEM_MINIATURA = int(os.environ.get("IMAGE_THUMB_SIZE", 320))
+IMAGEM_FEED = int(os.environ.get("IMAGE_FEED_SIZE", 1080))
+IMAGEM_QUALIDADE = int(os.environ.get("IMAGE_QUALITY", 80))
+IMAGEM_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+
+_pool_imagens = None
+_pool_imagens_pid = None
+_pool_imagens_lock = threading.Lock()
+
+def pool_imagens():
+    global _pool_imagens, _pool_imagens_pid
+
+    with _pool_imagens_lock:
+        if _pool_imagens is None or _pool_imagens_pid != os.getpid():
+            _pool_imagens = ThreadPoolExecutor(
+                max_workers=IMAGEM_WORKERS,
+                thread_name_prefix="imagens"
+            )
+            _pool_imagens_pid = os.getpid()
+
+    return _pool_imagens
+
+def gravar_variante(imagem, lado, destino):
+    if os.path.exists(destino):
+        return
+
+    copia = imagem.copy()
+    copia.thumbnail((lado, lado))
+
+    # temporário único: a mesma imagem pode estar a ser processada por
+    # duas tarefas ao mesmo tempo (repetida no post, ou repostada)
+    fd, temporario = tempfile.mkstemp(
+        dir=os.path.dirname(destino),
+        prefix=".variante-"
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as saida:
+            copia.save(saida, "WEBP", quality=IMAGEM_QUALIDADE, method=4)
+
+        os.replace(temporario, destino)
+    except BaseException:
+        os.remove(temporario)
+        raise
+
+def gerar_variantes(caminho):
+    """
+    Cria as variantes de um original ("/static/<pasta>/<nome>") e
+    grava-as nas imagens de posts e comentários que o usam.
+    """
+
+    pasta, nome = os.path.split(caminho.lstrip("/"))
+    base = os.path.splitext(nome)[0]
+
+    os.makedirs(os.path.join(pasta, "variantes"), exist_ok=True)
+
+    miniatura = f"/{pasta}/variantes/{base}-{IMAGEM_MINIATURA}.webp"
+    feed = f"/{pasta}/variantes/{base}-{IMAGEM_FEED}.webp"
+
+    with Image.open(os.path.join(pasta, nome)) as original:
+
+        # fotos de telemóvel vêm rodadas pelo EXIF
+        imagem = ImageOps.exif_transpose(original)
+
+        if imagem.mode not in ("RGB", "RGBA"):
+            imagem = imagem.convert("RGBA")
+
+        gravar_variante(imagem, IMAGEM_FEED, feed.lstrip("/"))
+        gravar_variante(imagem, IMAGEM_MINIATURA, miniatura.lstrip("/"))
+
+    with app.app_context():
+
+        PostImage.query.filter_by(
+            caminho=caminho
+        ).update(
+            {
+                PostImage.miniatura: miniatura,
+                PostImage.caminho_feed: feed
+            },
+            synchronize_session=False
+        )
+
+        Comment.query.filter_by(
+            imagem=caminho
+        ).update(
+            {
+                Comment.imagem_miniatura: miniatura,
+                Comment.imagem_feed: feed
+            },
+            synchronize_session=False
+        )
+
+        db.session.commit()
+
+def _gerar_variantes_seguro(caminho):
+    try:
+        gerar_variantes(caminho)
+    except Exception as e:
+        print("ERRO NAS VARIANTES", caminho, e)
+
+def agendar_variantes(caminhos):
+    """Gera as variantes em background depois do commit do pedido."""
+
+    if Image is None or IMAGEM_WORKERS <= 0:
+        return
+
+    def submeter(caminhos):
+        for caminho in caminhos:
+            pool_imagens().submit(_gerar_variantes_seguro, caminho)
+
+    # sem repetidos: os uploads têm nome pelo conteúdo
+    depois_do_commit(submeter, list(dict.fromkeys(caminhos)))
+
+@app.cli.command("gerar-variantes")
+def gerar_variantes_cmd():
+    if Image is None:
+        print("Pillow não está instalado")
+        return
+
+    caminhos = {
+        c for (c,) in db.session.query(PostImage.caminho).filter(
+            PostImage.miniatura.is_(None)
+        )
+    } | {
+        c for (c,) in db.session.query(Comment.imagem).filter(
+            Comment.imagem.like("/static/%"),
+            Comment.imagem_miniatura.is_(None)
+        )
+    }
+
+    for caminho in caminhos:
+        _gerar_variantes_seguro(caminho)
+
+    print("Imagens processadas:", len(caminhos))
+
 #================= CREATE POST =================
 @app.route("/posts", methods=["POST"])
 def criar_post():
 
-    print("FILES:", request.files)
-    print("IMAGENS:", request.files.getlist("imagem"))
-
     data = request.form
 
     autor_id = data.get("autor_id")
@@ -1578,6 +4053,23 @@ def criar_post():
     texto = data.get("texto", "")
     formatacao = data.get("formatacao", "")
 
+    # ==========================================
+    # UPLOADS (antes de escrever na BD)
+    # ==========================================
+
+    with LoteUploads() as lote:
+
+        imagens = lote.receber(
+            request.files.getlist("imagem"),
+            "posts",
+            so_imagens=True
+        )
+
+        ficheiros = lote.receber(
+            request.files.getlist("ficheiros"),
+            "files"
+        )
+
     # ==========================================
     # CRIAR POST
     # ==========================================
@@ -1591,83 +4083,22 @@ def criar_post():
 
     db.session.add(post)
 
-    # cria o ID antes de adicionar imagens/ficheiros
-    db.session.flush()
-
-    # ==========================================
-    # UPLOAD IMAGENS
-    # ==========================================
-
-    pasta_posts = os.path.join("static", "posts")
-    os.makedirs(pasta_posts, exist_ok=True)
-
-    imagens = request.files.getlist("imagem")
-
-    print("Recebi", len(imagens), "imagem(ns)")
-
-    for file in imagens[:10]:
-
-        if file.filename == "":
-            continue
-
-        extensao = os.path.splitext(file.filename)[1].lower()
-
-        if extensao not in [
-            ".png",
-            ".jpg",
-            ".jpeg",
-            ".webp"
-        ]:
-            extensao = ".png"
-
-        nome = str(uuid.uuid4()) + extensao
-
-        caminho = os.path.join(
-            pasta_posts,
-            nome
-        )
-
-        file.save(caminho)
-
-        print("Imagem guardada:", caminho)
-
+    for _, caminho in imagens:
         db.session.add(
             PostImage(
                 post_id=post.id,
-                caminho="/static/posts/" + nome
+                caminho=caminho
             )
         )
 
-    # ==========================================
-    # UPLOAD FICHEIROS
-    # ==========================================
-
-    pasta_ficheiros = os.path.join("static", "files")
-    os.makedirs(pasta_ficheiros, exist_ok=True)
-
-    ficheiros = request.files.getlist("ficheiros")
-
-    for file in ficheiros[:10]:
-
-        if file.filename == "":
-            continue
-
-        extensao = os.path.splitext(file.filename)[1]
-
-        novo_nome = str(uuid.uuid4()) + extensao
-
-        caminho = os.path.join(
-            pasta_ficheiros,
-            novo_nome
-        )
-
-        file.save(caminho)
+    agendar_variantes(caminho for _, caminho in imagens)
 
+    for nome, caminho in ficheiros:
         db.session.add(
             PostFile(
                 post_id=post.id,
-                nome=file.filename,
-                caminho="/static/files/" + novo_nome
+                nome=nome,
+                caminho=caminho
             )
         )
 
@@ -1689,6 +4120,9 @@ def criar_post():
 
         user.ultima_recompensa_post = datetime.utcnow()
 
+    # 📰 timelines de quem segue o autor
+    distribuir_post(post, user)
+
     db.session.commit()
 
     return jsonify({
@@ -1748,12 +4182,15 @@ def apagar_post(post_id):
     ).delete(synchronize_session=False)
 
     # 🧹 Apagar notificações associadas
-    Notification.query.filter(
+    apagar_notificacoes(
         db.or_(
             Notification.post_id == real_id,
             Notification.post_id == post_id
         )
-    ).delete(synchronize_session=False)
+    )
+
+    # 🔢 O original pode sobreviver (quando se apaga um repost)
+    recalcular_contadores(post_ids=[real_id])
 
     # 🗑 Apagar o próprio post
     db.session.delete(post)
@@ -1786,13 +4223,14 @@ def like(post_id):
     # ❌ DESCURTIR
     if existente:
         db.session.delete(existente)
+        ajustar_contador(Post.total_likes, real_id, -1)
 
         # 🧹 remover notificação de like
-        Notification.query.filter_by(
-            tipo="like",
-            origem_id=user_id,
-            post_id=real_id
-        ).delete(synchronize_session=False)
+        apagar_notificacoes(
+            Notification.tipo == "like",
+            Notification.origem_id == user_id,
+            Notification.post_id == real_id
+        )
 
         db.session.commit()
         return jsonify(liked=False)
@@ -1804,16 +4242,16 @@ def like(post_id):
         user_id=user_id
     )
     db.session.add(like)
+    ajustar_contador(Post.total_likes, real_id, 1)
 
     # 🔔 NOTIFICAÇÃO (se não for o próprio autor)
     if post.autor_id != user_id:
-        db.session.add(Notification(
-            id=str(uuid.uuid4()),
+        criar_notificacao(
             user_id=post.autor_id,
             tipo="like",
             origem_id=user_id,
             post_id=real_id
-        ))
+        )
 
     db.session.commit()
     return jsonify(liked=True)
@@ -1866,38 +4304,75 @@ def share_post(post_id):
 # ================= recebidos =================
 @app.route("/shares/<int:user_id>", methods=["GET"])
 def inbox(user_id):
-    shares = Share.query.filter_by(to_user_id=user_id).all()
-    res = []
-
-    for s in shares:
-        post = Post.query.get(s.post_id)
-        if not post:
-            continue
-
-        autor = User.query.get(post.autor_id)
-        sender = User.query.get(s.from_user_id)
 
-        # 🚫 BLOQUEIO: tu ↔ quem enviou
-        if existe_bloqueio(user_id, sender.id):
-            continue
+    # ?before=<data,id>&limit=N
+    autor = db.aliased(User)
+    sender = db.aliased(User)
+
+    query = db.session.query(
+        Share.id,
+        Share.data,
+        Share.from_user_id,
+        Post.id.label("post_id"),
+        Post.texto,
+        Post.imagem,
+        sender.username.label("sender_username"),
+        autor.username.label("autor_username"),
+        autor.avatar.label("autor_avatar"),
+        autor.banner.label("autor_banner")
+    ).join(
+        # partilhas de posts apagados ficam de fora
+        Post,
+        Post.id == Share.post_id
+    ).outerjoin(
+        autor,
+        autor.id == Post.autor_id
+    ).outerjoin(
+        sender,
+        sender.id == Share.from_user_id
+    ).filter(
+        Share.to_user_id == user_id
+    )
+
+    # 🚫 BLOQUEIO: tu ↔ quem enviou / tu ↔ autor do post
+    bloqueados = bloqueios_de(user_id)
+
+    if bloqueados:
+        query = query.filter(
+            Share.from_user_id.notin_(bloqueados),
+            Post.autor_id.notin_(bloqueados)
+        )
 
-        # 🚫 BLOQUEIO: tu ↔ autor do post
-        if existe_bloqueio(user_id, autor.id):
-            continue
+    try:
+        shares, proximo = paginar_keyset(
+            query,
+            Share.data,
+            Share.id,
+            # sem limit nem before: todas, como antes da paginação
+            ler_limite_compativel("before")
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
 
-        res.append({
-            "post_id": post.id,
-            "texto": post.texto,
-            "imagem": post.imagem,
-            "enviado_por": sender.username,
+    res = [
+        {
+            "id": s.id,
+            "post_id": s.post_id,
+            "texto": s.texto,
+            "imagem": s.imagem,
+            "enviado_por": s.sender_username,
+            "enviado_por_id": s.from_user_id,
+            "data": s.data.strftime("%d/%m/%Y %H:%M") if s.data else None,
             "autor": {
-                "username": autor.username,
-                "avatar": autor.avatar,
-                "banner": autor.banner
+                "username": s.autor_username,
+                "avatar": s.autor_avatar,
+                "banner": s.autor_banner
             }
-        })
+        }
+        for s in shares
+    ]
 
-    return jsonify(res)
+    return resposta_paginada(res, proximo)
     
 # ================= comentário =================
 @app.route("/posts/<post_id>/comment", methods=["POST"])
@@ -1960,39 +4435,6 @@ def comentar(post_id):
             error="Não podes comentar neste post"
         ), 403
 
-    # ==========================================
-    # IMAGEM
-    # ==========================================
-
-    imagem = data.get("imagem")
-
-    if "imagem" in request.files:
-
-        file = request.files["imagem"]
-
-        if file.filename != "":
-
-            nome = f"{uuid.uuid4()}.png"
-
-            pasta = os.path.join(
-                "static",
-                "comments"
-            )
-
-            os.makedirs(
-                pasta,
-                exist_ok=True
-            )
-
-            caminho = os.path.join(
-                pasta,
-                nome
-            )
-
-            file.save(caminho)
-
-            imagem = f"/static/comments/{nome}"
-
     # ==========================================
     # RESPOSTA A COMENTÁRIO
     # ==========================================
@@ -2024,6 +4466,25 @@ def comentar(post_id):
                 error="Não podes responder"
             ), 403
 
+    # ==========================================
+    # IMAGEM (antes de escrever na BD)
+    # ==========================================
+
+    imagem = data.get("imagem")
+
+    with LoteUploads() as lote:
+
+        enviadas = lote.receber(
+            request.files.getlist("imagem"),
+            "comments",
+            so_imagens=True,
+            maximo=1
+        )
+
+    if enviadas:
+        imagem = enviadas[0][1]
+        agendar_variantes([imagem])
+
     # ==========================================
     # CRIAR COMENTÁRIO
     # ==========================================
@@ -2039,6 +4500,8 @@ def comentar(post_id):
 
     db.session.add(comment)
 
+    ajustar_contador(Post.total_comentarios, post_id, 1)
+
     db.session.commit()
 
     # ==========================================
@@ -2095,6 +4558,7 @@ def like_comment(comment_id):
 
     if existente:
         db.session.delete(existente)
+        ajustar_contador(Comment.total_likes, comment_id, -1)
         db.session.commit()
         return jsonify(liked=False)
 
@@ -2104,16 +4568,16 @@ def like_comment(comment_id):
         user_id=user_id
     )
     db.session.add(like)
+    ajustar_contador(Comment.total_likes, comment_id, 1)
 
     # 🔔 NOTIFICAÇÃO (apenas se não houver bloqueio)
     if comment.autor_id != user_id:
-        db.session.add(Notification(
-            id=str(uuid.uuid4()),
+        criar_notificacao(
             user_id=comment.autor_id,
             tipo="like_comment",
             origem_id=user_id,
             comment_id=comment_id
-        ))
+        )
 
     db.session.commit()
     return jsonify(liked=True)
@@ -2213,6 +4677,7 @@ def follow_user(user_id):
     # 🔁 Deixar de seguir
     if existente:
         db.session.delete(existente)
+        ajustar_seguidores(follower_id, user_id, -1)
         db.session.commit()
         return jsonify(following=False)
 
@@ -2222,14 +4687,14 @@ def follow_user(user_id):
         follower_id=follower_id,
         followed_id=user_id
     ))
+    ajustar_seguidores(follower_id, user_id, 1)
 
     # 🔔 Notificação
-    db.session.add(Notification(
-        id=str(uuid.uuid4()),
+    criar_notificacao(
         user_id=user_id,
         tipo="follow",
         origem_id=follower_id
-    ))
+    )
 
     db.session.commit()
     return jsonify(following=True)
@@ -2261,22 +4726,23 @@ def block_user(user_id):
         blocked_id=user_id
     )
     db.session.add(block)
+    limpar_cache_bloqueios()
 
     # 🧹 REMOVER FOLLOWS (mantido)
-    Follow.query.filter(
+    apagar_follows(
         db.or_(
             db.and_(Follow.follower_id == blocker_id, Follow.followed_id == user_id),
             db.and_(Follow.follower_id == user_id, Follow.followed_id == blocker_id)
         )
-    ).delete(synchronize_session=False)
+    )
 
     # 🧹 REMOVER NOTIFICAÇÕES ENTRE AMBOS
-    Notification.query.filter(
+    apagar_notificacoes(
         db.or_(
             db.and_(Notification.user_id == blocker_id, Notification.origem_id == user_id),
             db.and_(Notification.user_id == user_id, Notification.origem_id == blocker_id)
         )
-    ).delete(synchronize_session=False)
+    )
 
     # 🧹 REMOVER LIKES ENTRE AMBOS
     Like.query.filter(
@@ -2303,12 +4769,19 @@ def block_user(user_id):
     ).delete(synchronize_session=False)
 
     # 🧹 REMOVER MENSAGENS ENTRE AMBOS
-    Message.query.filter(
+    apagar_mensagens(
         db.or_(
             db.and_(Message.from_user_id == blocker_id, Message.to_user_id == user_id),
             db.and_(Message.from_user_id == user_id, Message.to_user_id == blocker_id)
         )
-    ).delete(synchronize_session=False)
+    )
+
+    # 🔢 RECONTAR OS POSTS DE AMBOS
+    recalcular_contadores(
+        post_ids=db.session.query(Post.id).filter(
+            Post.autor_id.in_([blocker_id, user_id])
+        )
+    )
 
     db.session.commit()
     return jsonify(status="ok")
@@ -2330,6 +4803,12 @@ def unblock_user(user_id):
 
     # 🧱 Remover bloqueio
     db.session.delete(bloqueio)
+    db.session.flush()
+    limpar_cache_bloqueios()
+
+    # o que chegou durante o bloqueio volta a contar como por ler
+    recalcular_por_ler([int(blocker_id), user_id])
+
     db.session.commit()
 
     return jsonify(status="ok")
@@ -2350,84 +4829,266 @@ def editar_post(post_id):
     db.session.commit()
     return jsonify(status="ok")
 
-#================= LISTAR COMENTÁRIOS (COM RESPOSTAS) =================
-@app.route("/posts/<post_id>/comments", methods=["GET"])
-def listar_comentarios(post_id):
+#================= COMENTÁRIOS (THREAD) =================
+# Respostas incluídas em cada comentário de topo; as restantes
+# pedem-se a /comments/<id>/replies com o cursor "respostas_cursor".
+RESPOSTAS_PREVIA = 3
 
-    viewer_id = request.args.get("viewer_id", type=int)
+def comentarios_visiveis(viewer_id):
+    """Comentários sem os autores bloqueados pelo/do viewer (filtro em SQL)."""
 
-    comments = Comment.query.filter_by(
-        post_id=post_id
-    ).order_by(Comment.data).all()
+    query = Comment.query
+    bloqueados = bloqueios_de(viewer_id)
 
-    res = []
+    if bloqueados:
+        query = query.filter(Comment.autor_id.notin_(bloqueados))
 
-    for c in comments:
+    return query
 
-        if viewer_id and existe_bloqueio(
-            viewer_id,
-            c.autor_id
-        ):
-            continue
+def primeiras_respostas(parent_ids, viewer_id, quantas):
+    """As primeiras `quantas` respostas de cada pai, numa só query."""
 
-        autor = User.query.get(c.autor_id)
+    if not parent_ids or quantas <= 0:
+        return []
 
-        imagem_url = None
+    ordem = func.row_number().over(
+        partition_by=Comment.parent_id,
+        order_by=(Comment.data, Comment.id)
+    ).label("ordem")
 
-        if c.imagem:
-            imagem_url = request.host_url[:-1] + c.imagem
+    numeradas = comentarios_visiveis(viewer_id).with_entities(
+        Comment.id,
+        ordem
+    ).filter(
+        Comment.parent_id.in_(parent_ids)
+    ).subquery()
 
-        res.append({
+    return Comment.query.join(
+        numeradas,
+        numeradas.c.id == Comment.id
+    ).filter(
+        numeradas.c.ordem <= quantas
+    ).order_by(
+        Comment.data,
+        Comment.id
+    ).all()
 
-            # 🔥 ID COMENTÁRIO
-            "id": c.id,
+def serializar_comentarios(comentarios, viewer_id=None):
+    """
+    Serializa comentários com um número fixo de queries: autores,
+    likes do viewer e número de respostas são carregados de uma vez.
+    """
 
-            "texto": c.texto,
+    if not comentarios:
+        return []
 
-            # 🔥 IMAGEM
-            "imagem": imagem_url,
+    base_url = request.host_url.rstrip("/")
+    ids = [c.id for c in comentarios]
 
-            "data": c.data.strftime("%d/%m/%Y %H:%M"),
+    autores = {
+        a.id: a
+        for a in db.session.query(
+            User.id,
+            User.username,
+            User.avatar
+        ).filter(
+            User.id.in_({c.autor_id for c in comentarios})
+        )
+    }
+
+    gostados = set()
+
+    if viewer_id:
+        gostados = {
+            cid for (cid,) in db.session.query(CommentLike.comment_id).filter(
+                CommentLike.user_id == viewer_id,
+                CommentLike.comment_id.in_(ids)
+            )
+        }
+
+    respostas = dict(
+        comentarios_visiveis(viewer_id).with_entities(
+            Comment.parent_id,
+            func.count(Comment.id)
+        ).filter(
+            Comment.parent_id.in_(ids)
+        ).group_by(
+            Comment.parent_id
+        ).all()
+    )
+
+    res = []
+
+    for c in comentarios:
 
-            "likes": CommentLike.query.filter_by(
-                comment_id=c.id
-            ).count(),
+        autor = autores.get(c.autor_id)
 
+        res.append({
+            "id": c.id,
+            "parent_id": c.parent_id,
+            "texto": c.texto,
+            "imagem": base_url + c.imagem if c.imagem else None,
+            "imagem_feed": base_url + (c.imagem_feed or c.imagem) if c.imagem else None,
+            "imagem_miniatura": base_url + (c.imagem_miniatura or c.imagem) if c.imagem else None,
+            "data": c.data.strftime("%d/%m/%Y %H:%M"),
+            "likes": c.total_likes,
+            "liked": c.id in gostados,
+            "total_respostas": respostas.get(c.id, 0),
             "autor": {
                 "id": autor.id,
                 "username": autor.username,
                 "avatar": autor.avatar
-            }
-
+            } if autor else None
         })
 
-    return jsonify(res)
+    return res
+
+def montar_arvore(topo, previas, viewer_id):
+    """Comentários de topo com as respectivas respostas em "respostas"."""
+
+    itens = {
+        item["id"]: item
+        for item in serializar_comentarios(topo + previas, viewer_id)
+    }
+
+    for c in topo:
+        itens[c.id]["respostas"] = []
+        itens[c.id]["respostas_cursor"] = None
+
+    for c in previas:
+        pai = itens[c.parent_id]
+        pai["respostas"].append(itens[c.id])
+
+        # ?after= para continuar em /comments/<id>/replies
+        if pai["total_respostas"] > len(pai["respostas"]):
+            pai["respostas_cursor"] = gerar_cursor(c.data, c.id)
+        else:
+            pai["respostas_cursor"] = None
+
+    return [itens[c.id] for c in topo]
+
+#================= LISTAR COMENTÁRIOS (COM RESPOSTAS) =================
+@app.route("/posts/<post_id>/comments", methods=["GET"])
+def listar_comentarios(post_id):
+
+    viewer_id = request.args.get("viewer_id", type=int)
+
+    comments = comentarios_visiveis(viewer_id).filter(
+        Comment.post_id == post_id
+    ).order_by(Comment.data).all()
+
+    return jsonify(serializar_comentarios(comments, viewer_id))
+
+@app.route("/posts/<post_id>/comments/thread", methods=["GET"])
+def comentarios_em_arvore(post_id):
+
+    # ?after=<data,id>&limit=N&replies=N
+    viewer_id = request.args.get("viewer_id", type=int)
+
+    try:
+        topo, proximo = paginar_keyset(
+            comentarios_visiveis(viewer_id).filter(
+                Comment.post_id == post_id,
+                Comment.parent_id.is_(None)
+            ),
+            Comment.data,
+            Comment.id,
+            ler_limite(),
+            parametro="after"
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    previas = primeiras_respostas(
+        [c.id for c in topo],
+        viewer_id,
+        max(0, min(
+            request.args.get("replies", RESPOSTAS_PREVIA, type=int),
+            FEED_LIMITE_MAXIMO
+        ))
+    )
+
+    return resposta_paginada(
+        montar_arvore(topo, previas, viewer_id),
+        proximo
+    )
+
+@app.route("/comments/<comment_id>/replies", methods=["GET"])
+def respostas_comentario(comment_id):
+
+    # ?after=<data,id>&limit=N
+    viewer_id = request.args.get("viewer_id", type=int)
+
+    try:
+        respostas, proximo = paginar_keyset(
+            comentarios_visiveis(viewer_id).filter(
+                Comment.parent_id == comment_id
+            ),
+            Comment.data,
+            Comment.id,
+            ler_limite(),
+            parametro="after"
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    return resposta_paginada(
+        serializar_comentarios(respostas, viewer_id),
+        proximo
+    )
 #================= LISTAR NOTIFICAÇÕES =================
 @app.route("/notifications/<int:user_id>", methods=["GET"])
 def listar_notificacoes(user_id):
-    notifs = Notification.query.filter_by(
-        user_id=user_id
-    ).order_by(Notification.data.desc()).all()
-
-    res = []
-    for n in notifs:
-        origem = User.query.get(n.origem_id)
 
+    # ?before=<data,id> → mais antigas (do mais recente para trás)
+    # ?after=<data,id>  → mais recentes que o cursor (por ordem)
+    query = db.session.query(
+        Notification.id,
+        Notification.tipo,
+        Notification.origem_id,
+        Notification.post_id,
+        Notification.comment_id,
+        Notification.lida,
+        Notification.data,
+        User.username.label("origem"),
+        User.avatar.label("origem_avatar")
+    ).outerjoin(
+        User,
+        User.id == Notification.origem_id
+    ).filter(
+        Notification.user_id == user_id,
         # 🔒 IGNORAR NOTIFICAÇÕES DE UTILIZADORES BLOQUEADOS
-        if origem and existe_bloqueio(user_id, origem.id):
-            continue
+        sem_bloqueio_entre(Notification.user_id, Notification.origem_id)
+    )
 
-        res.append({
+    try:
+        notifs, proximo = paginar_keyset(
+            query,
+            Notification.data,
+            Notification.id,
+            # sem limit nem cursor: todas, como antes da paginação
+            ler_limite_compativel("before", "after"),
+            parametro="after" if request.args.get("after") else "before"
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    res = [
+        {
             "id": n.id,
             "tipo": n.tipo,
-            "origem": origem.username if origem else None,
+            "origem": n.origem,
+            "origem_id": n.origem_id,
+            "origem_avatar": n.origem_avatar,
             "post_id": n.post_id,
             "comment_id": n.comment_id,
             "lida": n.lida,
             "data": n.data.strftime("%d/%m/%Y %H:%M")
-        })
+        }
+        for n in notifs
+    ]
 
-    return jsonify(res)
+    return resposta_paginada(res, proximo)
 
 #================= MARCAR NOTIFICAÇÃO COMO LIDA =================
 @app.route("/notifications/<notif_id>/read", methods=["POST"])
@@ -2443,7 +5104,18 @@ def marcar_notificacao_lida(notif_id):
     if notif.user_id != user_id:
         return jsonify(error="Sem permissão"), 403
 
-    notif.lida = True
+    # só quem a muda de não lida → lida desconta (pedidos concorrentes)
+    marcada = Notification.query.filter_by(
+        id=notif.id,
+        lida=False
+    ).update(
+        {Notification.lida: True},
+        synchronize_session=False
+    )
+
+    if marcada == 1 and notif.origem_id not in bloqueios_de(notif.user_id):
+        ajustar_contador(User.notificacoes_por_ler, notif.user_id, -1)
+
     db.session.commit()
     return jsonify(status="ok")
 
@@ -2452,35 +5124,28 @@ def marcar_notificacao_lida(notif_id):
 def perfil_completo(user_id):
     viewer_id = request.args.get("viewer_id", type=int)
 
-    user = User.query.get(user_id)
-    if not user or user.apagado:
+    perfil = perfil_resumo(user_id)
+    if not perfil:
         return jsonify(error="Utilizador não encontrado"), 404
 
     # 🔒 BLOQUEIO TOTAL (não vê perfil)
     if viewer_id and existe_bloqueio(viewer_id, user_id):
         return jsonify(error="Perfil indisponível"), 403
 
-    seguidores = Follow.query.filter_by(followed_id=user_id).count()
-    seguindo = Follow.query.filter_by(follower_id=user_id).count()
-
     segue = False
     if viewer_id:
-        segue = Follow.query.filter_by(
+        segue = db.session.query(Follow.id).filter_by(
             follower_id=viewer_id,
             followed_id=user_id
         ).first() is not None
-        
-        return jsonify({
-            "id": user.id,
-            "nome": user.nome,
-            "username": user.username,
-            "avatar": user.avatar,
-            "banner": user.banner,
-            "bio": user.bio,
-            "seguidores": seguidores,
-            "seguindo": seguindo,
-            "seguindo_este_user": segue
-        })
+
+    resposta = jsonify(dict(perfil, seguindo_este_user=segue))
+
+    # o cliente revalida sempre; se nada mudou recebe 304 sem corpo
+    resposta.headers["Cache-Control"] = "private, no-cache"
+    resposta.add_etag()
+
+    return resposta.make_conditional(request)
 #================= POSTS DO PERFIL =================
 @app.route("/users/<int:user_id>/posts", methods=["GET"])
 def posts_perfil(user_id):
@@ -2490,24 +5155,25 @@ def posts_perfil(user_id):
     if viewer_id and existe_bloqueio(viewer_id, user_id):
         return jsonify(error="Conteúdo indisponível"), 403
 
-    posts = Post.query.filter_by(
-        autor_id=user_id
-    ).order_by(Post.data.desc()).all()
+    # ?before=<data,id>&limit=N (mesmo formato e regra do feed)
+    try:
+        posts, proximo = paginar_posts(
+            Post.query.filter_by(autor_id=user_id),
+            ler_limite_compativel("before")
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
 
-    res = []
-    for p in posts:
-        res.append({
-            "id": p.id,
-            "texto": p.texto,
-            "imagem": p.imagem,
-            "data": p.data.strftime("%d/%m/%Y %H:%M"),
-            "likes": Like.query.filter_by(post_id=p.id).count(),
-            "comentarios": Comment.query.filter_by(post_id=p.id).count(),
-            "pode_editar": viewer_id == user_id,
-            "pode_apagar": viewer_id == user_id
-        })
+    imagem_antiga = {p.id: p.imagem for p in posts}
 
-    return jsonify(res)
+    res = serializar_posts(posts)
+
+    for item in res:
+        item["imagem"] = imagem_antiga[item["id"]]
+        item["pode_editar"] = viewer_id == user_id
+        item["pode_apagar"] = viewer_id == user_id
+
+    return resposta_paginada(res, proximo)
 
 #================= ENVIAR MENSAGEM =================
 @app.route("/messages/send", methods=["POST"])
@@ -2548,14 +5214,17 @@ def enviar_mensagem():
     )
 
     db.session.add(msg)
+    db.session.flush()
+
+    ajustar_contador(User.mensagens_por_ler, to_user, 1)
+    registar_mensagem_conversa(msg)
 
     # 🔔 NOTIFICAÇÃO
-    db.session.add(Notification(
-        id=str(uuid.uuid4()),
+    criar_notificacao(
         user_id=to_user,
         tipo="message",
         origem_id=from_user
-    ))
+    )
 
     db.session.commit()
 
@@ -2564,12 +5233,26 @@ def enviar_mensagem():
 #================= CONVERSA =================
 @app.route("/messages/<int:user1>/<int:user2>", methods=["GET"])
 def conversa(user1, user2):
-    msgs = Message.query.filter(
-        db.or_(
-            db.and_(Message.from_user_id == user1, Message.to_user_id == user2),
-            db.and_(Message.from_user_id == user2, Message.to_user_id == user1)
+
+    # última página primeiro; ?before=<data,id> para as anteriores
+    try:
+        msgs, proximo = paginar_keyset(
+            Message.query.filter(
+                db.or_(
+                    db.and_(Message.from_user_id == user1, Message.to_user_id == user2),
+                    db.and_(Message.from_user_id == user2, Message.to_user_id == user1)
+                )
+            ),
+            Message.data,
+            Message.id,
+            # sem limit nem before: a conversa toda, como antes da paginação
+            ler_limite_compativel("before", padrao=50)
         )
-    ).order_by(Message.data).all()
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    # a página vem do mais recente para trás; devolve por ordem
+    msgs.reverse()
 
     res = []
     for m in msgs:
@@ -2582,25 +5265,78 @@ def conversa(user1, user2):
             "lida": m.lida
         })
 
-    return jsonify(res)
+    return resposta_paginada(res, proximo)
+
+#================= CONVERSAS (INBOX) =================
+@app.route("/conversations/<int:user_id>", methods=["GET"])
+def listar_conversas(user_id):
+
+    outro_id = db.case(
+        (Conversation.user_a_id == user_id, Conversation.user_b_id),
+        else_=Conversation.user_a_id
+    )
+
+    por_ler = db.case(
+        (Conversation.user_a_id == user_id, Conversation.por_ler_a),
+        else_=Conversation.por_ler_b
+    )
+
+    query = db.session.query(
+        Conversation.id,
+        Conversation.data,
+        Conversation.ultima_mensagem,
+        Conversation.ultimo_remetente_id,
+        outro_id.label("outro_id"),
+        por_ler.label("por_ler"),
+        User.username,
+        User.avatar
+    ).join(
+        User,
+        User.id == outro_id
+    ).filter(
+        db.or_(
+            Conversation.user_a_id == user_id,
+            Conversation.user_b_id == user_id
+        ),
+        sem_bloqueio_entre(user_id, outro_id)
+    )
+
+    try:
+        conversas, proximo = paginar_keyset(
+            query,
+            Conversation.data,
+            Conversation.id,
+            ler_limite()
+        )
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
+
+    return resposta_paginada([
+        {
+            "id": c.id,
+            "user": {
+                "id": c.outro_id,
+                "username": c.username,
+                "avatar": c.avatar
+            },
+            "ultima_mensagem": c.ultima_mensagem,
+            "ultimo_remetente": c.ultimo_remetente_id,
+            "por_ler": c.por_ler,
+            "data": c.data.strftime("%d/%m/%Y %H:%M")
+        }
+        for c in conversas
+    ], proximo)
 
 #================= MENSAGENS NÃO LIDAS =================
 @app.route("/messages/unread/<int:user_id>", methods=["GET"])
 def mensagens_nao_lidas(user_id):
 
-    # Buscar mensagens não lidas
-    msgs = Message.query.filter_by(
-        to_user_id=user_id,
-        lida=False
-    ).all()
-
-    total = 0
-    for m in msgs:
-        # 🔒 ignora mensagens de utilizadores bloqueados
-        if not existe_bloqueio(user_id, m.from_user_id):
-            total += 1
-
-    return jsonify(total=total)
+    # 🔒 o contador já exclui mensagens de utilizadores bloqueados
+    total = db.session.query(
+        User.mensagens_por_ler
+    ).filter_by(id=user_id).scalar()
+
+    return jsonify(total=total or 0)
 
 #================= MARCAR COMO LIDAS =================
 @app.route("/messages/read/<int:user_id>/<int:from_user>", methods=["POST"])
@@ -2610,12 +5346,22 @@ def marcar_lidas(user_id, from_user):
     if existe_bloqueio(user_id, from_user):
         return jsonify(status="bloqueado")
 
-    Message.query.filter_by(
+    lidas = Message.query.filter_by(
         to_user_id=user_id,
         from_user_id=from_user,
         lida=False
     ).update({"lida": True})
 
+    if lidas:
+        ajustar_contador(User.mensagens_por_ler, user_id, -lidas)
+
+    a, b, por_ler = lado_conversa(user_id, from_user)
+
+    Conversation.query.filter_by(
+        user_a_id=a,
+        user_b_id=b
+    ).update({por_ler: 0}, synchronize_session=False)
+
     db.session.commit()
     return jsonify(status="ok")
 
@@ -2898,21 +5644,180 @@ def adicionar_moedas():
         "moedas": user.moedas
     })
 
+# ================= MEDIA (AVATARES E BANNERS) =================
+# Os ficheiros de static/avatars e static/banners são lidos uma vez para
+# um manifesto em memória (nome → caminho, tamanho, mtime, sha256).
+# Cada pedido é só um lookup: ETag forte, Cache-Control longo/immutable
+# e 304 quando o browser já tem a versão certa. Se existir "<nome>.br"
+# ou "<nome>.gz" ao lado do original, é servido a quem o aceitar.
+# Um nome desconhecido volta a ler a pasta (no máximo a cada
+# MEDIA_RESCAN_SECONDS), para apanhar ficheiros novos sem reiniciar.
+MEDIA_MAX_AGE = int(os.environ.get("MEDIA_MAX_AGE", 30 * 24 * 3600))
+MEDIA_RESCAN = float(os.environ.get("MEDIA_RESCAN_SECONDS", 60))
+
+COMPRESSOES = [("br", ".br"), ("gzip", ".gz")]
+
+class ManifestoMedia:
+
+    def __init__(self, pasta, extensoes=()):
+        self.pasta = pasta
+
+        # extensões tentadas (por ordem) quando o pedido vem sem extensão
+        self.extensoes = extensoes
+
+        self._ficheiros = {}
+        self._lido_em = None
+        self._lock = threading.Lock()
+
+    def carregar(self):
+        ficheiros = {}
+        anteriores = self._ficheiros
+
+        if os.path.isdir(self.pasta):
+            for entrada in os.scandir(self.pasta):
+
+                if (
+                    not entrada.is_file()
+                    or entrada.name.startswith(".")
+                    or entrada.name.endswith((".br", ".gz"))
+                ):
+                    continue
+
+                info = entrada.stat()
+                antigo = anteriores.get(entrada.name)
+
+                # só volta a calcular o hash se o ficheiro mudou
+                if antigo and (antigo["tamanho"], antigo["mtime"]) == (info.st_size, info.st_mtime):
+                    ficheiros[entrada.name] = antigo
+                    continue
+
+                with open(entrada.path, "rb") as f:
+                    etag = hashlib.file_digest(f, "sha256").hexdigest()[:32]
+
+                ficheiros[entrada.name] = {
+                    "caminho": entrada.path,
+                    "tamanho": info.st_size,
+                    "mtime": info.st_mtime,
+                    "etag": etag,
+                    "tipo": mimetypes.guess_type(entrada.name)[0] or "application/octet-stream",
+                    "comprimidos": {
+                        codificacao: entrada.path + sufixo
+                        for codificacao, sufixo in COMPRESSOES
+                        if os.path.isfile(entrada.path + sufixo)
+                    }
+                }
+
+        with self._lock:
+            self._ficheiros = ficheiros
+            self._lido_em = time.monotonic()
+
+    def _encontrar(self, candidatos):
+        for candidato in candidatos:
+            if candidato in self._ficheiros:
+                return self._ficheiros[candidato]
+
+        return None
+
+    def _atual(self, ficheiro):
+        """O ficheiro no disco ainda é o do manifesto?"""
+
+        try:
+            info = os.stat(ficheiro["caminho"])
+        except FileNotFoundError:
+            return False
+
+        return (info.st_size, info.st_mtime) == (ficheiro["tamanho"], ficheiro["mtime"])
+
+    def procurar(self, nome):
+        candidatos = [nome] + [nome + ext for ext in self.extensoes]
+
+        ficheiro = self._encontrar(candidatos)
+
+        if ficheiro and self._atual(ficheiro):
+            return ficheiro
+
+        # substituído ou apagado → relê já (senão o ETag antigo dava 304
+        # com conteúdo velho); desconhecido → relê no máximo a cada
+        # MEDIA_RESCAN segundos
+        if (
+            ficheiro
+            or self._lido_em is None
+            or time.monotonic() - self._lido_em >= MEDIA_RESCAN
+        ):
+            self.carregar()
+            ficheiro = self._encontrar(candidatos)
+
+        return ficheiro
+
+manifesto_avatares = ManifestoMedia(
+    os.path.join(BASE_DIR, "static", "avatars")
+)
+manifesto_banners = ManifestoMedia(
+    os.path.join(BASE_DIR, "static", "banners"),
+    extensoes=(".png", ".jpg", ".jpeg")
+)
+
+def servir_media(manifesto, nome):
+    ficheiro = manifesto.procurar(nome)
+
+    if not ficheiro:
+        return None
+
+    caminho = ficheiro["caminho"]
+    etag = ficheiro["etag"]
+    codificacao = None
+
+    for aceite, comprimido in ficheiro["comprimidos"].items():
+        if aceite in request.accept_encodings:
+            caminho = comprimido
+            codificacao = aceite
+            etag = f"{etag}-{aceite}"
+            break
+
+    try:
+        resposta = send_file(
+            caminho,
+            mimetype=ficheiro["tipo"],
+            etag=etag,
+            max_age=MEDIA_MAX_AGE,
+            conditional=True
+        )
+    except FileNotFoundError:
+        # apagado entre a verificação e a abertura
+        return None
+
+    resposta.cache_control.public = True
+    resposta.cache_control.immutable = True
+
+    if ficheiro["comprimidos"]:
+        resposta.vary.add("Accept-Encoding")
+
+    if codificacao:
+        resposta.headers["Content-Encoding"] = codificacao
+
+    return resposta
+
+@app.route('/avatar/<filename>')
+def servir_avatar(filename):
+    resposta = servir_media(manifesto_avatares, filename)
+
+    if resposta is None:
+        return "Avatar não encontrado", 404
+
+    return resposta
+
 @app.route('/banner/<filename>')
 def servir_banner(filename):
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    path = os.path.join(base_dir, 'static', 'banners')
-
-    print("A SERVIR BANNER:", filename)
+    resposta = servir_media(manifesto_banners, filename)
 
-    for ext in [".png", ".jpg", ".jpeg"]:
-        file = filename + ext
-        full_path = os.path.join(path, file)
+    if resposta is None:
+        return "Banner não encontrado", 404
 
-        if os.path.exists(full_path):
-            return send_from_directory(path, file)
+    return resposta
 
-    return "Banner não encontrado", 404
+# lidos ao arrancar (com --preload, uma vez para todos os workers)
+manifesto_avatares.carregar()
+manifesto_banners.carregar()
 
 # =========================================================
 # ADMIN
@@ -3073,9 +5978,9 @@ def admin_delete_post(post_id):
     ).delete()
 
     # apagar notificações
-    Notification.query.filter_by(
-        post_id=post.id
-    ).delete()
+    apagar_notificacoes(
+        Notification.post_id == post.id
+    )
 
     db.session.delete(post)
     db.session.commit()
@@ -3103,6 +6008,8 @@ def admin_delete_comment(comment_id):
 
     CommentLike.query.filter_by(comment_id=comment.id).delete()
 
+    ajustar_contador(Post.total_comentarios, comment.post_id, -1)
+
     db.session.delete(comment)
     db.session.commit()
 
@@ -3141,6 +6048,8 @@ def admin_ban_user(user_id):
     user.email_banido = True
     user.ban_reason = motivo
 
+    posts_afetados, comentarios_afetados = contadores_afetados_por(user.id)
+
     # =========================================
     # APAGAR POSTS
     # =========================================
@@ -3159,9 +6068,9 @@ def admin_ban_user(user_id):
             post_id=p.id
         ).delete()
 
-        Notification.query.filter_by(
-            post_id=p.id
-        ).delete()
+        apagar_notificacoes(
+            Notification.post_id == p.id
+        )
 
         db.session.delete(p)
 
@@ -3189,34 +6098,43 @@ def admin_ban_user(user_id):
     # APAGAR MENSAGENS
     # =========================================
 
-    Message.query.filter(
+    apagar_mensagens(
         db.or_(
             Message.from_user_id == user.id,
             Message.to_user_id == user.id
         )
-    ).delete()
+    )
 
     # =========================================
     # APAGAR FOLLOWS
     # =========================================
 
-    Follow.query.filter(
+    apagar_follows(
         db.or_(
             Follow.follower_id == user.id,
             Follow.followed_id == user.id
         )
-    ).delete()
+    )
 
     # =========================================
     # APAGAR NOTIFICAÇÕES
     # =========================================
 
-    Notification.query.filter(
+    apagar_notificacoes(
         db.or_(
             Notification.user_id == user.id,
             Notification.origem_id == user.id
         )
-    ).delete()
+    )
+
+    # =========================================
+    # RECONTAR POSTS/COMENTÁRIOS DE TERCEIROS
+    # =========================================
+
+    recalcular_contadores(
+        post_ids=posts_afetados,
+        comment_ids=comentarios_afetados
+    )
 
     db.session.commit()
 
@@ -3501,25 +6419,361 @@ def toggle_public_admin():
         visible=user.mostrar_publicamente
     )
 
+# ================= DIRETÓRIO DE USERS =================
+# Ordenado por lower(username) (índice ix_users_lower_username).
+# Com ?limit= devolve uma página e X-Next-Cursor; sem limit devolve o
+# diretório inteiro como um array JSON em stream, lido em lotes.
+DIRETORIO_LOTE = 500
+DIRETORIO_LIMITE_MAXIMO = 1000
+
+def consulta_diretorio(prefixo=None):
+
+    nome = func.lower(User.username)
+
+    query = db.session.query(
+        User.id,
+        User.username,
+        User.avatar,
+        User.role,
+        nome.label("chave")
+    ).filter(
+        User.apagado == False,
+        # contas Google ainda sem username não entram no diretório
+        # (e um NULL estragava o cursor)
+        User.username.isnot(None)
+    )
+
+    if prefixo:
+        # intervalo [prefixo, prefixo seguinte) → usa o índice
+        seguinte = prefixo[:-1] + chr(ord(prefixo[-1]) + 1)
+        query = query.filter(nome >= prefixo, nome < seguinte)
+
+    return query
+
+def pagina_diretorio(query, depois, limite):
+
+    nome = func.lower(User.username)
+
+    if depois:
+        chave, item_id = depois
+        query = query.filter(
+            db.or_(
+                nome > chave,
+                db.and_(nome == chave, User.id > item_id)
+            )
+        )
+
+    return query.order_by(nome, User.id).limit(limite).all()
+
+def ler_cursor_diretorio(valor):
+    """Cursor "<id>,<username>" → (username, id)."""
+
+    if not valor:
+        return None
+
+    item_id, _, chave = valor.partition(",")
+
+    return chave, int(item_id)
+
+def user_diretorio(u):
+    return {
+        "id": u.id,
+        "username": u.username,
+        "avatar": u.avatar,
+        "role": u.role
+    }
+
 @app.route("/users/list", methods=["GET"])
 def listar_users():
 
-    users = User.query.filter_by(
-        apagado=False
-    ).all()
+    # ?q=<prefixo>&after=<cursor>&limit=N
+    prefixo = (request.args.get("q") or "").strip().lower()
 
-    res = []
+    try:
+        depois = ler_cursor_diretorio(request.args.get("after"))
+    except ValueError:
+        return jsonify(error="Cursor inválido"), 400
 
-    for u in users:
+    query = consulta_diretorio(prefixo)
 
-        res.append({
-            "id": u.id,
-            "username": u.username,
-            "avatar": u.avatar,
-            "role": u.role
-        })
+    if request.args.get("limit"):
 
-    return jsonify(res)
+        limite = ler_limite(maximo=DIRETORIO_LIMITE_MAXIMO)
+        users = pagina_diretorio(query, depois, limite + 1)
+
+        proximo = None
+
+        if len(users) > limite:
+            users = users[:limite]
+            proximo = f"{users[-1].id},{users[-1].chave}"
+
+        return resposta_paginada(
+            [user_diretorio(u) for u in users],
+            proximo
+        )
+
+    def gerar():
+        cursor = depois
+        primeiro = True
+
+        yield "["
+
+        while True:
+            lote = pagina_diretorio(query, cursor, DIRETORIO_LOTE)
+
+            for u in lote:
+                yield ("" if primeiro else ",") + json.dumps(user_diretorio(u))
+                primeiro = False
+
+            if len(lote) < DIRETORIO_LOTE:
+                break
+
+            cursor = (lote[-1].chave, lote[-1].id)
+
+        yield "]"
+
+    return Response(
+        stream_with_context(gerar()),
+        mimetype="application/json"
+    )
+
+# ================= PESQUISA DE USERS =================
+# Índice em memória (por processo) sobre username e nome: prefixos numa
+# lista ordenada (bisect) e trigramas para erros de escrita. Atualizado
+# depois do commit quando um user é criado, alterado ou apagado; como os
+# outros workers não veem essas alterações, o índice é reconstruído
+# quando passa USER_SEARCH_TTL segundos.
+PESQUISA_TTL = float(os.environ.get("USER_SEARCH_TTL", 300))
+PESQUISA_LIMITE_MAXIMO = 50
+
+def normalizar_pesquisa(texto):
+    """minúsculas e sem acentos: "João" → "joao"."""
+
+    texto = unicodedata.normalize("NFKD", (texto or "").strip().lower())
+    return "".join(ch for ch in texto if not unicodedata.combining(ch))
+
+def trigramas(texto):
+    texto = f"  {texto} "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+class IndicePesquisaUsers:
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self._carregado_em = None
+        self._limpar()
+
+    def _limpar(self):
+        self._users = {}       # id → dados públicos
+        self._termos = {}      # id → termos indexados
+        self._ordenados = []   # [(termo, id)] para prefixos
+        self._trigramas = {}   # trigrama → {ids}
+
+    def _termos_de(self, dados):
+        termos = [normalizar_pesquisa(dados["username"])]
+
+        # perfis privados só se encontram pelo username
+        if dados["mostrar_nome"] and not dados["perfil_privado"] and dados["nome"]:
+            termos += normalizar_pesquisa(dados["nome"]).split()
+
+        return [t for t in termos if t]
+
+    def _remover(self, user_id):
+        self._users.pop(user_id, None)
+
+        for termo in self._termos.pop(user_id, []):
+            i = bisect.bisect_left(self._ordenados, (termo, user_id))
+
+            if i < len(self._ordenados) and self._ordenados[i] == (termo, user_id):
+                del self._ordenados[i]
+
+            for tri in trigramas(termo):
+                ids = self._trigramas.get(tri)
+
+                if ids:
+                    ids.discard(user_id)
+
+    def _adicionar(self, dados):
+        user_id = dados["id"]
+
+        self._remover(user_id)
+
+        # apagados, banidos e perfis escondidos não aparecem na pesquisa
+        if dados["apagado"] or dados["banido"] or not dados["mostrar_publicamente"]:
+            return
+
+        termos = self._termos_de(dados)
+
+        self._users[user_id] = dados
+        self._termos[user_id] = termos
+
+        for termo in termos:
+            bisect.insort(self._ordenados, (termo, user_id))
+
+            for tri in trigramas(termo):
+                self._trigramas.setdefault(tri, set()).add(user_id)
+
+    def _carregar(self):
+        linhas = db.session.query(
+            User.id,
+            User.username,
+            User.nome,
+            User.avatar,
+            User.mostrar_nome,
+            User.mostrar_publicamente,
+            User.perfil_privado,
+            User.apagado,
+            User.banido
+        ).all()
+
+        with self._lock:
+            self._limpar()
+
+            for u in linhas:
+                self._adicionar(dict(u._mapping))
+
+            self._carregado_em = time.monotonic()
+
+    def atualizar(self, dados):
+        with self._lock:
+            if self._carregado_em is not None:
+                self._adicionar(dados)
+
+    def remover(self, user_id):
+        with self._lock:
+            self._remover(user_id)
+
+    def _expirado(self):
+        return (
+            self._carregado_em is None
+            or time.monotonic() - self._carregado_em > self.ttl
+        )
+
+    def pesquisar(self, q, limite=10, excluir=()):
+
+        if self._expirado():
+            with self._lock_carga:
+                # outro pedido pode ter recarregado enquanto esperávamos
+                if self._expirado():
+                    self._carregar()
+
+        q = normalizar_pesquisa(q)
+
+        if not q:
+            return []
+
+        pontos = {}
+
+        with self._lock:
+
+            # 1) prefixos (username pesa mais que o nome)
+            i = bisect.bisect_left(self._ordenados, (q, -1))
+
+            while i < len(self._ordenados) and self._ordenados[i][0].startswith(q):
+                termo, user_id = self._ordenados[i]
+                dados = self._users[user_id]
+
+                if termo == normalizar_pesquisa(dados["username"]):
+                    valor = 3.0 if termo == q else 2.0
+                else:
+                    valor = 1.5
+
+                pontos[user_id] = max(pontos.get(user_id, 0), valor)
+                i += 1
+
+            # 2) trigramas, para "joa silv" ou erros de escrita
+            if len(q) >= 3:
+                tris_q = trigramas(q)
+                comuns = {}
+
+                for tri in tris_q:
+                    for user_id in self._trigramas.get(tri, ()):
+                        comuns[user_id] = comuns.get(user_id, 0) + 1
+
+                for user_id, n in comuns.items():
+                    semelhanca = n / len(tris_q)
+
+                    if semelhanca >= 0.5:
+                        pontos[user_id] = max(pontos.get(user_id, 0), semelhanca)
+
+            ordenados = sorted(
+                (
+                    (-valor, self._users[user_id]["username"] or "", user_id)
+                    for user_id, valor in pontos.items()
+                    if user_id not in excluir
+                )
+            )[:limite]
+
+            return [
+                {
+                    "id": user_id,
+                    "username": self._users[user_id]["username"],
+                    "nome": self._users[user_id]["nome"]
+                    if self._users[user_id]["mostrar_nome"]
+                    and not self._users[user_id]["perfil_privado"] else None,
+                    "avatar": self._users[user_id]["avatar"],
+                    "privado": bool(self._users[user_id]["perfil_privado"]),
+                    "relevancia": round(-valor, 2)
+                }
+                for valor, _, user_id in ordenados
+            ]
+
+indice_pesquisa_users = IndicePesquisaUsers(PESQUISA_TTL)
+
+def dados_pesquisa(user):
+    return {
+        "id": user.id,
+        "username": user.username,
+        "nome": user.nome,
+        "avatar": user.avatar,
+        "mostrar_nome": user.mostrar_nome,
+        "mostrar_publicamente": user.mostrar_publicamente,
+        "perfil_privado": user.perfil_privado,
+        "apagado": user.apagado,
+        "banido": user.banido
+    }
+
+@db.event.listens_for(User, "after_insert")
+@db.event.listens_for(User, "after_update")
+def user_gravado_para_pesquisa(mapper, connection, target):
+    depois_do_commit(
+        indice_pesquisa_users.atualizar,
+        dados_pesquisa(target),
+        sessao_db=db.object_session(target)
+    )
+
+@db.event.listens_for(User, "after_delete")
+def user_apagado_da_pesquisa(mapper, connection, target):
+    depois_do_commit(
+        indice_pesquisa_users.remover,
+        target.id,
+        sessao_db=db.object_session(target)
+    )
+
+@app.route("/users/search", methods=["GET"])
+def pesquisar_users():
+
+    # ?q=<texto>&viewer_id=N&limit=N
+    viewer_id = request.args.get("viewer_id", type=int)
+    limite = max(1, min(
+        request.args.get("limit", 10, type=int),
+        PESQUISA_LIMITE_MAXIMO
+    ))
+
+    excluir = set(bloqueios_de(viewer_id))
+
+    if viewer_id:
+        excluir.add(viewer_id)
+
+    return jsonify(
+        indice_pesquisa_users.pesquisar(
+            request.args.get("q", ""),
+            limite,
+            excluir
+        )
+    )
 
 @app.route("/admin/admins", methods=["GET"])
 def listar_admins_admin():
@@ -3741,6 +6995,8 @@ def admin_delete_user(user_id):
     # 🧹 LIMPEZA COMPLETA (igual ao ban)
     # ===============================
 
+    posts_afetados, comentarios_afetados = contadores_afetados_por(user.id)
+
     Post.query.filter_by(autor_id=user.id).delete()
 
     Comment.query.filter_by(autor_id=user.id).delete()
@@ -3749,26 +7005,33 @@ def admin_delete_user(user_id):
 
     CommentLike.query.filter_by(user_id=user.id).delete()
 
-    Message.query.filter(
+    apagar_mensagens(
         db.or_(
             Message.from_user_id == user.id,
             Message.to_user_id == user.id
         )
-    ).delete()
+    )
 
-    Follow.query.filter(
+    apagar_follows(
         db.or_(
             Follow.follower_id == user.id,
             Follow.followed_id == user.id
         )
-    ).delete()
+    )
 
-    Notification.query.filter(
+    apagar_notificacoes(
         db.or_(
             Notification.user_id == user.id,
             Notification.origem_id == user.id
         )
-    ).delete()
+    )
+
+    invalidar_timelines([user.id])
+
+    recalcular_contadores(
+        post_ids=posts_afetados,
+        comment_ids=comentarios_afetados
+    )
 
     # 🗑 apagar user
     db.session.delete(user)
@@ -3805,14 +7068,13 @@ def avisar_user():
     # ===============================
     # 🔔 criar notificação
     # ===============================
-    db.session.add(Notification(
-        id=str(uuid.uuid4()),
+    criar_notificacao(
         user_id=user.id,
         tipo="admin_warning",
         origem_id=admin_id,
         post_id=None,
         comment_id=None
-    ))
+    )
 
     db.session.commit()
 
@@ -3868,9 +7130,11 @@ def apagar_comentario(comment_id):
     ).delete()
 
     # apagar notificações
-    Notification.query.filter_by(
-        comment_id=comment.id
-    ).delete()
+    apagar_notificacoes(
+        Notification.comment_id == comment.id
+    )
+
+    ajustar_contador(Post.total_comentarios, comment.post_id, -1)
 
     db.session.delete(comment)
 
@@ -3878,8 +7142,159 @@ def apagar_comentario(comment_id):
 
     return jsonify(status="ok")
 
+# ================= LOGIN GOOGLE (HANDOFF) =================
+# Como no PKCE: a app gera um segredo aleatório (verifier), abre o
+# browser em /login/google?challenge=<sha256(verifier) em hex> e vai
+# perguntando /google-login/status?verifier=<segredo>. O callback grava
+# o resultado com a chave do challenge (que atravessa o OAuth na sessão
+# Flask); só quem tem o verifier o consegue ler, e a primeira leitura
+# apaga-o. Dois logins ao mesmo tempo não se misturam e qualquer worker
+# responde ao poll.
+#
+# OAUTH_HANDOFF_BACKEND:
+#   sql     → tabela oauth_handoffs (partilhada por todos os workers)
+#   memoria → dict por processo; só serve com um worker
+#   redis   → REDIS_URL (precisa do pacote redis)
+OAUTH_HANDOFF_TTL = int(os.environ.get("OAUTH_HANDOFF_TTL", 600))
+
+ESTADO_LOGIN_VAZIO = {
+    "logged": False,
+    "exists": False,
+    "id": None,
+    "email": None,
+    "username": None,
+    "picture": None,
+    "google_name": None,
+    "session_token": None
+}
+
+class HandoffMemoria:
+
+    nome = "memoria"
+
+    def __init__(self):
+        self._cache = CacheTTL(OAUTH_HANDOFF_TTL)
+
+    def consumir(self, chave):
+        return self._cache.pop(chave)
+
+    def gravar(self, chave, dados):
+        self._cache.set(chave, dict(dados))
+
+class HandoffSQL:
+
+    nome = "sql"
+
+    def consumir(self, chave):
+        tabela = OAuthHandoff.__table__
+
+        with db.engine.begin() as conn:
+            dados = conn.execute(
+                db.select(tabela.c.dados).where(
+                    tabela.c.nonce == chave,
+                    tabela.c.expira_em > datetime.utcnow()
+                )
+            ).scalar()
+
+            if not dados:
+                return None
+
+            # só um poll concorrente consegue apagar (e ficar com) a linha
+            apagadas = conn.execute(
+                tabela.delete().where(tabela.c.nonce == chave)
+            ).rowcount
+
+        return json.loads(dados) if apagadas == 1 else None
+
+    def gravar(self, chave, dados):
+        agora = datetime.utcnow()
+        tabela = OAuthHandoff.__table__
+
+        # ligação própria: fica gravado mesmo que o pedido faça rollback
+        with db.engine.begin() as conn:
+
+            conn.execute(
+                tabela.delete().where(
+                    db.or_(
+                        tabela.c.nonce == chave,
+                        tabela.c.expira_em <= agora
+                    )
+                )
+            )
+
+            conn.execute(
+                tabela.insert(),
+                dict(
+                    nonce=chave,
+                    dados=json.dumps(dados),
+                    expira_em=agora + timedelta(seconds=OAUTH_HANDOFF_TTL)
+                )
+            )
+
+class HandoffRedis:
+
+    nome = "redis"
+
+    def __init__(self):
+        import redis
+
+        self._redis = redis.Redis.from_url(
+            os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+        )
+
+    def consumir(self, chave):
+        pipe = self._redis.pipeline()
+        pipe.get("oauth_handoff:" + chave)
+        pipe.delete("oauth_handoff:" + chave)
+        dados, apagadas = pipe.execute()
+
+        return json.loads(dados) if dados and apagadas else None
+
+    def gravar(self, chave, dados):
+        self._redis.setex(
+            "oauth_handoff:" + chave,
+            OAUTH_HANDOFF_TTL,
+            json.dumps(dados)
+        )
+
+HANDOFFS = {
+    h.nome: h
+    for h in [HandoffSQL, HandoffMemoria, HandoffRedis]
+}
+
+handoff_login = HANDOFFS[os.environ.get("OAUTH_HANDOFF_BACKEND", "sql")]()
+
+def ler_challenge(valor):
+    """sha256 do verifier em hex (64 caracteres) ou None."""
+
+    valor = (valor or "").strip().lower()
+
+    if len(valor) == 64 and all(c in "0123456789abcdef" for c in valor):
+        return valor
+
+    return None
+
+def challenge_de(verifier):
+    """Chave do handoff a partir do segredo da app, ou None se inválido."""
+
+    verifier = (verifier or "").strip()
+
+    if not 32 <= len(verifier) <= 128:
+        return None
+
+    return hashlib.sha256(verifier.encode()).hexdigest()
+
 @app.route("/login/google")
 def login_google():
+
+    challenge = ler_challenge(request.args.get("challenge"))
+
+    if not challenge:
+        return jsonify(error="challenge inválido"), 400
+
+    # guardado na sessão do browser até ao callback
+    session["oauth_challenge"] = challenge
+
     redirect_uri = url_for("google_callback", _external=True)
     return google.authorize_redirect(redirect_uri)
     
@@ -3888,6 +7303,9 @@ def google_callback():
 
     google.authorize_access_token()
 
+    # lido antes do session.clear() do login
+    challenge = session.pop("oauth_challenge", None)
+
     resp = google.get("https://openidconnect.googleapis.com/v1/userinfo")
     info = resp.json()
 
@@ -3936,10 +7354,8 @@ def google_callback():
         db.session.add(nova_sessao)
         db.session.commit()
 
-    # 🔥 TOKEN ÚNICO PARA TKINTER
-    global google_login_state
-
-    google_login_state = {
+    # 🔥 TOKEN ÚNICO PARA TKINTER (só para quem tem o verifier)
+    estado = {
         "logged": True,
         "exists": (
             user is not None
@@ -3960,6 +7376,9 @@ def google_callback():
         "session_token": session_token
     }
 
+    if challenge:
+        handoff_login.gravar(challenge, estado)
+
     return f"""
 <!DOCTYPE html>
 <html lang="pt">
@@ -4014,8 +7433,14 @@ body {{
     
 @app.route("/google-login/status")
 def google_login_status():
-    global google_login_state
-    return jsonify(google_login_state)
+
+    chave = challenge_de(request.args.get("verifier"))
+
+    if not chave:
+        return jsonify(error="verifier inválido"), 400
+
+    # a primeira leitura com sucesso apaga o resultado
+    return jsonify(handoff_login.consumir(chave) or ESTADO_LOGIN_VAZIO)
 
 @app.route("/register-google", methods=["POST"])
 def register_google():
@@ -4083,10 +7508,6 @@ def register_google():
         user.role = "admin"
         db.session.commit()
 
-    google_login_state["exists"] = True
-    google_login_state["id"] = user.id
-    google_login_state["username"] = username
-
     return jsonify(
         status="ok",
         id=user.id
@@ -4147,17 +7568,14 @@ def auto_login():
 
     token = data.get("session_token")
 
-    sessao = UserSession.query.filter_by(
-        session_token=token,
-        active=True
-    ).first()
+    sessao = estado_sessao(token)
 
-    if not sessao:
+    if not sessao or not sessao["active"]:
         return jsonify(
             status="error"
         ), 401
 
-    user = User.query.get(sessao.user_id)
+    user = sessao["user"]
 
     if not user:
         return jsonify(
@@ -4166,10 +7584,10 @@ def auto_login():
 
     return jsonify(
         status="ok",
-        id=user.id,
-        username=user.username,
-        avatar=user.avatar,
-        role=user.role,
+        id=user["id"],
+        username=user["username"],
+        avatar=user["avatar"],
+        role=user["role"],
         session_token=token
     )
     
@@ -4202,7 +7620,7 @@ def security_login():
         )
 
     # 🔒 password
-    if user.password != hash_password(password):
+    if not confirmar_password(user, password):
         return render_template(
             "security_login.html",
             erro="Password inválida"
@@ -4222,7 +7640,9 @@ def security_login():
             erro="Conta apagada"
         )
 
-    # ✅ login OK
+    # ✅ login OK (grava o hash convertido, se foi o caso)
+    db.session.commit()
+
     session["security_user"] = user.id
 
     return redirect("/security-sessions")
@@ -4278,16 +7698,14 @@ def check_session():
     if not token:
         return jsonify(active=False), 400
 
-    sessao = UserSession.query.filter_by(
-        session_token=token
-    ).first()
+    sessao = estado_sessao(token)
 
     # ❌ sessão não existe
     if not sessao:
         return jsonify(active=False), 404
 
     # ❌ sessão existe mas está terminada
-    if not sessao.active:
+    if not sessao["active"]:
         return jsonify(active=False)
 
     # ✅ sessão válida
@@ -4707,8 +8125,6 @@ def edit_user(user_id):
         user.ban_reason = data.get("ban_reason", user.ban_reason)
         user.ia_ban_reason = data.get("ia_ban_reason", user.ia_ban_reason)
 
-        db.session.commit()
-
         # ================= HISTÓRICO =================
 
         if username_antigo != user.username:
@@ -4799,6 +8215,8 @@ def edit_user(user_id):
                 admin_id
             )
 
+        db.session.commit()
+
         return "✔ Utilizador atualizado com sucesso!"
 
     return f"""
@@ -5047,10 +8465,10 @@ def open_ticket(ticket_id):
             border-radius:10px;
         ">
 
-            <b>{sender_name}</b>
+            <b>{escape(sender_name)}</b>
 
             <div style="margin-top:8px;white-space:pre-wrap;">
-                {m.message}
+                {escape(m.message)}
             </div>
 
         </div>
@@ -5093,9 +8511,9 @@ border-right:1px solid #1f2937;
 
 <h3>Informações</h3>
 
-<p><b>Assunto</b><br>{ticket.title}</p>
+<p><b>Assunto</b><br>{escape(ticket.title)}</p>
 
-<p><b>Prioridade</b><br>{ticket.priority.upper()}</p>
+<p><b>Prioridade</b><br>{escape(ticket.priority.upper())}</p>
 
 <p><b>Status</b><br>{"🔴 FECHADO" if is_closed else "🟢 ABERTO"}</p>
 
@@ -5107,11 +8525,11 @@ border-right:1px solid #1f2937;
 
 <p><b>ID</b><br>{user.id}</p>
 
-<p><b>Username</b><br>{user.username}</p>
+<p><b>Username</b><br>{escape(user.username)}</p>
 
-<p><b>Email</b><br>{user.email}</p>
+<p><b>Email</b><br>{escape(user.email)}</p>
 
-<p><b>Recuperação</b><br>{user.email_recuperacao or "-"}</p>
+<p><b>Recuperação</b><br>{escape(user.email_recuperacao or "-")}</p>
 
 <p><b>Moedas</b><br>{user.moedas}</p>
 
@@ -5143,9 +8561,9 @@ text-decoration:none;
 
 <p><b>ID</b><br>{admin.id if admin else "-"}</p>
 
-<p><b>Username</b><br>{admin.username if admin else "Ainda não atribuído"}</p>
+<p><b>Username</b><br>{escape(admin.username) if admin else "Ainda não atribuído"}</p>
 
-<p><b>Email</b><br>{admin.email if admin else "-"}</p>
+<p><b>Email</b><br>{escape(admin.email) if admin else "-"}</p>
 <hr>
 
 <a href="/admin/tickets"
@@ -5368,64 +8786,7 @@ font-weight:bold;
 
 </div>
 
-<script>
-
-function atualizarChat(){{
-
-fetch("/ticket/{ticket.id}/messages")
-
-.then(r=>r.text())
-
-.then(html=>{{
-
-const chatDiv = document.getElementById("chat");
-const totalScroll = chatDiv.scrollHeight - chatDiv.clientHeight;
-const estaNoFundo = (chatDiv.scrollTop >= totalScroll - 50);
-
-chatDiv.innerHTML=html;
-
-if(estaNoFundo || chatDiv.scrollTop === 0){{
-    chatDiv.scrollTop = chatDiv.scrollHeight;
-}}
-
-}});
-
-}}
-
-// INTERCEPTAR SUBMISSÃO DO ADMIN VIA AJAX
-const form = document.getElementById("form-resposta");
-if(form){{
-    form.addEventListener("submit", function(e){{
-        e.preventDefault();
-        
-        const msgInput = document.getElementById("message-text");
-        const msgValor = msgInput.value;
-        const senderValor = document.getElementById("sender").value;
-        
-        if(!msgValor.trim()) return;
-
-        fetch("/ticket/{ticket.id}/reply", {{
-            method: "POST",
-            headers: {{ "Content-Type": "application/json" }},
-            body: JSON.stringify({{ message: msgValor, sender: senderValor }})
-        }})
-        .then(r => r.json())
-        .then(data => {{
-            if(data.status === "ok"){{
-                msgInput.value = "";
-                atualizarChat();
-            }}
-        }});
-    }});
-}}
-
-setInterval(atualizarChat,3000);
-
-window.onload=function(){{
-document.getElementById("chat").scrollTop = document.getElementById("chat").scrollHeight;
-}};
-
-</script>
+{script_chat_ticket(ticket, user, admin, messages[-1].id if messages else 0)}
 
 </body>
 
@@ -5721,7 +9082,7 @@ def admin_ticket_login():
             return "❌ Login inválido"
 
         # 2. verifica password
-        if user.password != hash_password(password):
+        if not confirmar_password(user, password):
             return "❌ Login inválido"
 
         # 3. verifica se é admin
@@ -5729,6 +9090,7 @@ def admin_ticket_login():
             return "❌ Sem permissão (não és admin)"
 
         # 4. login OK
+        db.session.commit()
         session["admin_ticket_id"] = user.id
 
         return redirect("/admin/tickets")
@@ -5973,25 +9335,214 @@ def messages_live(ticket_id):
         for m in messages
     ])
 
-@app.route("/notifications/<int:user_id>")
-def notifications(user_id):
+def mensagens_ticket_desde(ticket_id, last_id):
+    return [
+        mensagem_ticket_json(m)
+        for m in TicketMessage.query.filter(
+            TicketMessage.ticket_id == ticket_id,
+            TicketMessage.id > last_id
+        ).order_by(TicketMessage.id.asc())
+    ]
+
+@app.route("/ticket/<int:ticket_id>/messages/stream")
+def messages_stream(ticket_id):
+    """
+    Server-Sent Events com as mensagens novas do ticket. O browser
+    reenvia Last-Event-ID ao religar, por isso nada se perde entre ligações.
+    """
 
-    notifs = Notification.query.filter_by(
-        user_id=user_id
-    ).order_by(Notification.data.desc()).limit(50).all()
+    try:
+        last_id = int(
+            request.headers.get("Last-Event-ID")
+            or request.args.get("last_id")
+            or 0
+        )
+    except ValueError:
+        return jsonify(error="last_id inválido"), 400
 
-    return jsonify([
-        {
-            "id": n.id,
-            "tipo": n.tipo,
-            "from": n.origem_id,
-            "post_id": n.post_id,
-            "comment_id": n.comment_id,
-            "lida": n.lida,
-            "data": n.data.isoformat()
+    # não deixar os streams ocuparem todas as threads do worker
+    if not vagas_streams_tickets.acquire(blocking=False):
+        return jsonify(error="Demasiados streams abertos"), 503, {"Retry-After": "30"}
+
+    def evento(m):
+        return f"id: {m['id']}\nevent: mensagem\ndata: {json.dumps(m)}\n\n"
+
+    def gerar():
+        ultimo = last_id
+
+        # subscreve antes de ler a base de dados para não perder nada
+        fila = canal_tickets.subscrever(ticket_id)
+
+        try:
+            yield "retry: 3000\n\n"
+
+            pendentes = mensagens_ticket_desde(ticket_id, ultimo)
+            db.session.remove()
+
+            agora = time.monotonic()
+            fim = agora + TICKET_STREAM_DURACAO
+            proximo_ping = agora + TICKET_STREAM_HEARTBEAT
+
+            while True:
+
+                for m in pendentes:
+                    if m["id"] > ultimo:
+                        ultimo = m["id"]
+                        yield evento(m)
+
+                if time.monotonic() >= fim:
+                    # o browser volta a ligar com o Last-Event-ID
+                    return
+
+                try:
+                    pendentes = [fila.get(timeout=TICKET_STREAM_POLL)]
+                except queue.Empty:
+
+                    # mensagens gravadas noutros workers
+                    pendentes = mensagens_ticket_desde(ticket_id, ultimo)
+                    db.session.remove()
+
+                    if time.monotonic() >= proximo_ping:
+                        proximo_ping = time.monotonic() + TICKET_STREAM_HEARTBEAT
+                        yield ": ping\n\n"
+        finally:
+            canal_tickets.cancelar(ticket_id, fila)
+
+    resposta = Response(
+        stream_with_context(gerar()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
         }
-        for n in notifs
-    ])
+    )
+
+    # corre mesmo que o cliente desligue antes do primeiro byte
+    resposta.call_on_close(vagas_streams_tickets.release)
+
+    return resposta
+
+def json_em_script(valor):
+    """
+    json.dumps seguro dentro de <script>: um username com "</script>"
+    fecharia o bloco e o resto correria como HTML da página do admin.
+    """
+
+    return (
+        json.dumps(valor)
+        .replace("<", "\\u003c")
+        .replace(">", "\\u003e")
+        .replace("&", "\\u0026")
+    )
+
+def script_chat_ticket(ticket, user, admin, ultimo_id):
+    """JS comum às páginas de ticket (user e admin)."""
+
+    nome_user = json_em_script(user.username if user else "Utilizador")
+    nome_admin = json_em_script(admin.username if admin else "Administrador")
+
+    return f"""
+<script>
+
+let ultimoId = {ultimo_id};
+
+function adicionarMensagem(m){{
+
+if(m.id <= ultimoId) return;
+ultimoId = m.id;
+
+const chatDiv = document.getElementById("chat");
+const totalScroll = chatDiv.scrollHeight - chatDiv.clientHeight;
+const estaNoFundo = (chatDiv.scrollTop >= totalScroll - 50);
+
+const admin = m.sender === "admin";
+
+const div = document.createElement("div");
+div.style.cssText = "margin-bottom:15px;padding:12px;border-radius:10px;"
+    + "background:" + (admin ? "#2563eb" : "#1e293b") + ";"
+    + "border-left:5px solid " + (admin ? "#60a5fa" : "#22c55e") + ";";
+
+const nome = document.createElement("b");
+nome.textContent = admin ? {nome_admin} : {nome_user};
+
+const texto = document.createElement("div");
+texto.style.cssText = "margin-top:8px;white-space:pre-wrap;";
+texto.textContent = m.message;
+
+div.appendChild(nome);
+div.appendChild(texto);
+chatDiv.appendChild(div);
+
+if(estaNoFundo){{
+    chatDiv.scrollTop = chatDiv.scrollHeight;
+}}
+
+}}
+
+function atualizarChat(){{
+
+fetch("/ticket/{ticket.id}/messages/live?last_id=" + ultimoId)
+
+.then(r=>r.json())
+
+.then(lista=>lista.forEach(adicionarMensagem));
+
+}}
+
+let polling = null;
+
+function usarPolling(){{
+    if(!polling) polling = setInterval(atualizarChat,3000);
+}}
+
+if(window.EventSource){{
+    const fonte = new EventSource("/ticket/{ticket.id}/messages/stream?last_id=" + ultimoId);
+    fonte.addEventListener("mensagem", function(e){{
+        adicionarMensagem(JSON.parse(e.data));
+    }});
+    // servidor sem vagas (503): o EventSource desiste e fica o polling
+    fonte.onerror = function(){{
+        if(fonte.readyState === EventSource.CLOSED) usarPolling();
+    }};
+}} else {{
+    usarPolling();
+}}
+
+// INTERCEPTAR SUBMISSÃO VIA AJAX
+const form = document.getElementById("form-resposta");
+if(form){{
+    form.addEventListener("submit", function(e){{
+        e.preventDefault();
+
+        const msgInput = document.getElementById("message-text");
+        const msgValor = msgInput.value;
+        const senderValor = document.getElementById("sender").value;
+
+        if(!msgValor.trim()) return;
+
+        fetch("/ticket/{ticket.id}/reply", {{
+            method: "POST",
+            headers: {{ "Content-Type": "application/json" }},
+            body: JSON.stringify({{ message: msgValor, sender: senderValor }})
+        }})
+        .then(r => r.json())
+        .then(data => {{
+            if(data.status === "ok"){{
+                msgInput.value = "";
+                // a própria mensagem aparece já, mesmo que o stream
+                // esteja ligado a outro worker
+                atualizarChat();
+            }}
+        }});
+    }});
+}}
+
+window.onload=function(){{
+document.getElementById("chat").scrollTop = document.getElementById("chat").scrollHeight;
+}};
+
+</script>
+"""
 
 @app.route("/follow/request", methods=["POST"])
 def follow_request():
@@ -6023,6 +9574,7 @@ def follow_request():
     )
 
     db.session.add(fr)
+    ajustar_contador(User.pedidos_seguir_pendentes, to_user, 1)
     db.session.commit()
 
     return jsonify(ok=True)
@@ -6042,7 +9594,9 @@ def accept_follow():
         follower_id=req.from_user,
         followed_id=req.to_user
     ))
+    ajustar_seguidores(req.from_user, req.to_user, 1)
 
+    descontar_pedido_seguir(req)
     db.session.delete(req)
 
     db.session.commit()
@@ -6058,6 +9612,7 @@ def reject_follow():
     if not req:
         return jsonify(error="Request não existe"), 404
 
+    descontar_pedido_seguir(req)
     db.session.delete(req)
     db.session.commit()
 
@@ -6093,6 +9648,7 @@ def cancel_follow_request():
     if not req:
         return jsonify(error="Pedido não encontrado"), 404
 
+    descontar_pedido_seguir(req)
     db.session.delete(req)
     db.session.commit()
 
@@ -6101,12 +9657,11 @@ def cancel_follow_request():
 @app.route("/follow/pending/count/<int:user_id>")
 def pending_follow_count(user_id):
 
-    count = FollowRequest.query.filter_by(
-        to_user=user_id,
-        status="pending"
-    ).count()
+    count = db.session.query(
+        User.pedidos_seguir_pendentes
+    ).filter_by(id=user_id).scalar()
 
-    return jsonify(count=count)
+    return jsonify(count=count or 0)
 
 @app.route("/follow/pending/<int:user_id>")
 def pending_follow_list(user_id):
@@ -6135,12 +9690,29 @@ def pending_follow_list(user_id):
 @app.route("/notifications/unread/<int:user_id>")
 def unread_notifications(user_id):
 
-    total = Notification.query.filter_by(
-        user_id=user_id,
-        lida=False
-    ).count()
+    total = db.session.query(
+        User.notificacoes_por_ler
+    ).filter_by(id=user_id).scalar()
+
+    return jsonify(total=total or 0)
+
+@app.route("/badges/<int:user_id>")
+def badges(user_id):
 
-    return jsonify(total=total)
+    contadores = db.session.query(
+        User.notificacoes_por_ler,
+        User.mensagens_por_ler,
+        User.pedidos_seguir_pendentes
+    ).filter_by(id=user_id).first()
+
+    if not contadores:
+        return jsonify(error="User não encontrado"), 404
+
+    return jsonify(
+        notificacoes=contadores.notificacoes_por_ler,
+        mensagens=contadores.mensagens_por_ler,
+        pedidos_seguir=contadores.pedidos_seguir_pendentes
+    )
 
 @app.route("/notifications/read-all", methods=["POST"])
 def read_all_notifications():
@@ -6154,6 +9726,13 @@ def read_all_notifications():
         "lida": True
     })
 
+    User.query.filter_by(
+        id=data["user_id"]
+    ).update(
+        {User.notificacoes_por_ler: 0},
+        synchronize_session=False
+    )
+
     db.session.commit()
 
     return jsonify(ok=True)
@@ -6210,10 +9789,10 @@ def view_ticket(ticket_id):
             border-radius:10px;
         ">
 
-            <b>{nome}</b>
+            <b>{escape(nome)}</b>
 
             <div style="margin-top:8px;white-space:pre-wrap;">
-                {m.message}
+                {escape(m.message)}
             </div>
 
         </div>
@@ -6257,9 +9836,9 @@ border-right:1px solid #1f2937;
 
 <p><b>Status</b><br>{"🔴 FECHADO" if is_closed else "🟢 ABERTO"}</p>
 
-<p><b>Prioridade</b><br>{ticket.priority.upper()}</p>
+<p><b>Prioridade</b><br>{escape(ticket.priority.upper())}</p>
 
-<p><b>Admin Responsável</b><br>{admin.username if admin else "Ainda não atribuído"}</p>
+<p><b>Admin Responsável</b><br>{escape(admin.username) if admin else "Ainda não atribuído"}</p>
 
 <hr>
 
@@ -6491,64 +10070,7 @@ border:1px solid #334155;
 
 </div>
 
-<script>
-
-function atualizarChat(){{
-
-fetch("/ticket/{ticket.id}/messages")
-
-.then(r=>r.text())
-
-.then(html=>{{
-
-const chatDiv = document.getElementById("chat");
-const totalScroll = chatDiv.scrollHeight - chatDiv.clientHeight;
-const estaNoFundo = (chatDiv.scrollTop >= totalScroll - 50);
-
-chatDiv.innerHTML=html;
-
-if(estaNoFundo || chatDiv.scrollTop === 0){{
-    chatDiv.scrollTop = chatDiv.scrollHeight;
-}}
-
-}});
-
-}}
-
-// INTERCEPTAR SUBMISSÃO VIA AJAX
-const form = document.getElementById("form-resposta");
-if(form){{
-    form.addEventListener("submit", function(e){{
-        e.preventDefault();
-        
-        const msgInput = document.getElementById("message-text");
-        const msgValor = msgInput.value;
-        const senderValor = document.getElementById("sender").value;
-        
-        if(!msgValor.trim()) return;
-
-        fetch("/ticket/{ticket.id}/reply", {{
-            method: "POST",
-            headers: {{ "Content-Type": "application/json" }},
-            body: JSON.stringify({{ message: msgValor, sender: senderValor }})
-        }})
-        .then(r => r.json())
-        .then(data => {{
-            if(data.status === "ok"){{
-                msgInput.value = "";
-                atualizarChat();
-            }}
-        }});
-    }});
-}}
-
-setInterval(atualizarChat,3000);
-
-window.onload=function(){{
-document.getElementById("chat").scrollTop = document.getElementById("chat").scrollHeight;
-}};
-
-</script>
+{script_chat_ticket(ticket, user, admin, messages[-1].id if messages else 0)}
 
 </body>
 
@@ -6757,7 +10279,7 @@ def settings_change_password():
 
     confirm_password = data.get("confirm_password", "")
 
-    if hash_password(current_password) != user.password:
+    if not verificar_password(current_password, user.password):
         return jsonify(
             status="error",
             msg="Password atual incorreta"
@@ -6769,7 +10291,7 @@ def settings_change_password():
             msg="As passwords não coincidem"
         )
 
-    if hash_password(new_password) == user.password:
+    if verificar_password(new_password, user.password):
         return jsonify(
             status="error",
             msg="A nova password não pode ser igual à atual"
@@ -6779,11 +10301,9 @@ def settings_change_password():
         user_id=user.id
     ).all()
 
-    novo_hash = hash_password(new_password)
-
     for antiga in historico:
 
-        if antiga.password_hash == novo_hash:
+        if verificar_password(new_password, antiga.password_hash):
 
             return jsonify(
                 status="error",
@@ -6803,7 +10323,7 @@ def settings_change_password():
 
     )
 
-    user.password = novo_hash
+    user.password = hash_password(new_password)
 
     user.password_changed = datetime.utcnow()
 
@@ -6845,6 +10365,9 @@ def logout_all():
         }
     )
 
+    # update em massa não dispara os eventos do modelo
+    invalidar_sessoes(user_id=user_id)
+
     db.session.commit()
 
     return jsonify(status="ok")
@@ -7129,8 +10652,6 @@ def add_recovery_question():
         ensure_ascii=False
     )
 
-    db.session.commit()
-
     adicionar_atividade(
         user.id,
         "recovery_questions",
@@ -7140,6 +10661,8 @@ def add_recovery_question():
         "user"
     )
 
+    db.session.commit()
+
     return jsonify(status="ok")
     
 @app.route("/api/settings/delete-recovery-question", methods=["POST"])
@@ -7174,8 +10697,6 @@ def delete_recovery_question():
         ensure_ascii=False
     )
 
-    db.session.commit()
-
     adicionar_atividade(
         user.id,
         "recovery_questions",
@@ -7185,6 +10706,8 @@ def delete_recovery_question():
         "user"
     )
 
+    db.session.commit()
+
     return jsonify(status="ok")
 
 # ================= ALTERAR PERGUNTAS DE RECUPERAÇÃO =================
@@ -7203,7 +10726,7 @@ def update_recovery_questions():
 
     password = data.get("password", "")
 
-    if hash_password(password) != user.password:
+    if not verificar_password(password, user.password):
         return jsonify(
             status="error",
             msg="Password incorreta"
@@ -7243,8 +10766,6 @@ def update_recovery_questions():
         ensure_ascii=False
     )
 
-    db.session.commit()
-
     adicionar_atividade(
         user.id,
         "recovery_questions",
@@ -7254,6 +10775,8 @@ def update_recovery_questions():
         "user"
     )
 
+    db.session.commit()
+
     return jsonify(
         status="ok",
         msg="Perguntas atualizadas com sucesso."
@@ -7286,7 +10809,7 @@ def send_email_change_code():
             msg="Preencha todos os campos"
         )
 
-    if hash_password(password) != user.password:
+    if not verificar_password(password, user.password):
         return jsonify(
             status="error",
             msg="Password incorreta"
@@ -7368,9 +10891,6 @@ def verify_email_change(token):
         user.email_changed = datetime.utcnow()
 
 
-        db.session.commit()
-
-
         adicionar_atividade(
             user.id,
             "email",
@@ -7381,6 +10901,9 @@ def verify_email_change(token):
         )
 
 
+        db.session.commit()
+
+
         return render_template(
             "email_change_verified.html"
         )